@@ -0,0 +1,312 @@
+''' Benchmark suite of the cafes pipeline in final_project.py.
+
+Synthetic yelp search results are generated for a number of cities, then
+every stage is timed separately on a throwaway cache file and database,
+then run again with tracemalloc for its peak memory:
+
+    cache_load  load_cache() and a cached get_yelp_bussiness_search() per city
+    parse       parse_buss_attrs() over every city's search result
+    ingest      sync_city_businesses() per city (writes every business into database)
+    query       get_busi_db_info(), get_aver_info_db() and
+                get_best_busi_based_on_rating_review() per city
+    figure      map_businesses(), kde_rating() and review_rating_scatter()
+
+Usage:
+
+    $ python benchmark.py --businesses 10 1000 100000 --output bench.json
+    $ python benchmark.py --businesses 1000 --compare bench.json
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import final_project as fp
+
+STAGES = ["cache_load", "parse", "ingest", "query", "figure"]
+PRICES = ["", "$", "$$", "$$$", "$$$$"]
+RATINGS = [1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]
+
+
+def make_synthetic_states(n_cities, n_states=10):
+    ''' make a states_and_cities dict with synthetic city names
+
+    Parameters
+    ----------
+    n_cities: int
+        total number of cities
+    n_states: int
+        number of states the cities are spread over
+
+    Returns
+    -------
+    dict
+        key is a state name and value is the cities names
+    '''
+    n_states = max(1, min(n_states, n_cities))
+    states_and_cities = {}
+    for i in range(n_cities):
+        state = "state %02d" % (i % n_states)
+        states_and_cities.setdefault(state, []).append("City %05d" % i)
+    return states_and_cities
+
+
+def make_synthetic_business(rng, city, index):
+    ''' make one business dict shaped like a yelp fusion search result
+
+    Parameters
+    ----------
+    rng: random.Random
+        random generator
+    city: string
+        city of the business
+    index: int
+        number of the business, used in its name
+
+    Returns
+    -------
+    dict
+        a yelp business dict
+    '''
+    return {"id": "bench-%s-%d" % (city.replace(" ", "-").lower(), index),
+            "name": "Cafe %d" % index,
+            "location": {"city": city,
+                         "address1": "%d Main St" % rng.randint(1, 9999),
+                         "zip_code": "%05d" % rng.randint(10000, 99999)},
+            "coordinates": {"latitude": rng.uniform(25.0, 49.0),
+                            "longitude": rng.uniform(-124.0, -67.0)},
+            "price": rng.choice(PRICES),
+            "image_url": "https://example.com/%d.jpg" % index,
+            "rating": rng.choice(RATINGS),
+            "review_count": rng.randint(0, 5000)}
+
+
+def make_synthetic_dataset(n_businesses, n_cities, seed=507):
+    ''' make synthetic states and yelp search results. The businesses of
+    a city have at least two different ratings when there are two of them,
+    as the kde plot of equal ratings can't be computed.
+
+    Parameters
+    ----------
+    n_businesses: int
+        total number of businesses, spread round-robin over the cities
+    n_cities: int
+        number of cities
+    seed: int
+        random seed, the same seed gives the same dataset
+
+    Returns
+    -------
+    tuple
+        (states_and_cities dict, dict of city name to yelp search result)
+    '''
+    rng = random.Random(seed)
+    states_and_cities = make_synthetic_states(n_cities)
+    cities = [c for state in states_and_cities for c in states_and_cities[state]]
+    yelp_dicts = {}
+    for city in cities:
+        yelp_dicts[city] = {"businesses": [], "total": 0}
+    for i in range(n_businesses):
+        city = cities[i % len(cities)]
+        yelp_dicts[city]["businesses"].append(make_synthetic_business(rng, city, i))
+    for city in cities:
+        businesses = yelp_dicts[city]["businesses"]
+        if len(businesses) > 1 and len(set(bu["rating"] for bu in businesses)) == 1:
+            businesses[1]["rating"] = rng.choice(
+                [r for r in RATINGS if r != businesses[0]["rating"]])
+        yelp_dicts[city]["total"] = len(businesses)
+    return states_and_cities, yelp_dicts
+
+
+def time_stage(func, items, reset=None):
+    ''' run func twice: once timed without tracing, since tracemalloc
+    slows pure Python far more than sqlite, then once again tracing its
+    peak memory
+
+    Parameters
+    ----------
+    func: function
+        the stage to run, without arguments
+    items: int
+        number of items the stage handles, used for throughput
+    reset: function
+        called before the traced run to undo what the timed run changed,
+        None if func can simply run again
+
+    Returns
+    -------
+    dict
+        seconds, items, throughput (items per second) and peak memory bytes
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        if reset is not None:
+            reset()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"seconds": seconds,
+            "items": items,
+            "throughput": items / seconds if seconds > 0 else None,
+            "peak_memory_bytes": peak}
+
+
+def run_benchmark(n_businesses, n_cities, figure_cities=5, seed=507):
+    ''' run every stage on a synthetic dataset in a temporary directory
+
+    Parameters
+    ----------
+    n_businesses: int
+        total number of businesses
+    n_cities: int
+        number of cities, at most half the businesses so that
+        every city has two different ratings for the kde plot
+    figure_cities: int
+        number of cities to build figures for
+    seed: int
+        random seed of the dataset
+
+    Returns
+    -------
+    dict
+        the run, with the stages results
+    '''
+    n_cities = max(1, min(n_cities, n_businesses // 2))
+    states_and_cities, yelp_dicts = make_synthetic_dataset(n_businesses, n_cities, seed)
+    cities = list(yelp_dicts.keys())
+    figure_list = sorted(cities, key=lambda c: len(yelp_dicts[c]["businesses"]),
+                         reverse=True)[:figure_cities]
+    old_names = (fp.CACHE_FILE_NAME, fp.DB_NAME, fp.CACHE_DICT)
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fp.CACHE_FILE_NAME = os.path.join(tmp_dir, "cache.json")
+        fp.DB_NAME = os.path.join(tmp_dir, "bench_db.sqlite")
+        try:
+            yelp_url = "https://api.yelp.com/v3/businesses/search"
+            cache = {}
+            for city in cities:
+                params = {"location": city, "term": "coffee", "limit": 50}
+                cache[fp.construct_unique_key(yelp_url, params)] = yelp_dicts[city]
+            fp.save_cache(cache)
+            fp.save_city_table(states_and_cities)
+
+            def cache_load():
+                fp.CACHE_DICT = fp.load_cache()
+                for city in cities:
+                    fp.get_yelp_bussiness_search(city)
+
+            def parse():
+                for city in cities:
+                    fp.parse_buss_attrs(city, yelp_dicts[city])
+
+            def ingest():
+                for city in cities:
+                    fp.sync_city_businesses(city, yelp_dicts[city])
+
+            def reset_ingest():
+                conn = sqlite3.connect(fp.DB_NAME)
+                conn.execute("DELETE FROM Businesses")
+                conn.execute("DELETE FROM CityRefresh")
+                conn.commit()
+                conn.close()
+                fp.invalidate_city_dataset()
+
+            def query():
+                for city in cities:
+                    params = {"City": city}
+                    fp.get_busi_db_info(["Name", "rating", "review_number"], params)
+                    fp.get_aver_info_db("rating", params)
+                    fp.get_best_busi_based_on_rating_review(params)
+
+            def figure():
+                for city in figure_list:
+                    fp.map_businesses(city)
+                    fp.kde_rating(city)
+                    fp.review_rating_scatter(city)
+
+            stages["cache_load"] = time_stage(cache_load, len(cities))
+            stages["parse"] = time_stage(parse, n_businesses)
+            stages["ingest"] = time_stage(ingest, n_businesses, reset_ingest)
+            stages["query"] = time_stage(query, len(cities), fp.invalidate_city_dataset)
+            stages["figure"] = time_stage(figure, 3 * len(figure_list))
+        finally:
+            fp.CACHE_FILE_NAME, fp.DB_NAME, fp.CACHE_DICT = old_names
+    return {"businesses": n_businesses, "cities": n_cities, "stages": stages}
+
+
+def print_run(run, baseline=None):
+    ''' print the stages results of a run, and the ratio of time to
+    the matching baseline run if given
+
+    Parameters
+    ----------
+    run: dict
+        a run from run_benchmark
+    baseline: dict
+        a run from a previous results file with the same businesses number
+    '''
+    title = "%s businesses in %s cities" % (run["businesses"], run["cities"])
+    print("-" * len(title))
+    print(title)
+    print("-" * len(title))
+    for stage in STAGES:
+        res = run["stages"][stage]
+        line = "%-10s %10.4f s %12.1f items/s %10.1f KiB" % (
+            stage, res["seconds"], res["throughput"] or 0.0,
+            res["peak_memory_bytes"] / 1024)
+        if baseline is not None and stage in baseline["stages"]:
+            old_seconds = baseline["stages"][stage]["seconds"]
+            if old_seconds > 0:
+                line += "   x%.2f of baseline" % (res["seconds"] / old_seconds)
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the cafes pipeline stages.")
+    parser.add_argument("--businesses", type=int, nargs="+", default=[10, 1000],
+                        help="numbers of businesses to benchmark, e.g. 10 1000 100000")
+    parser.add_argument("--cities", type=int, default=20,
+                        help="number of cities the businesses are spread over")
+    parser.add_argument("--figure-cities", type=int, default=5,
+                        help="number of cities to build figures for")
+    parser.add_argument("--seed", type=int, default=507)
+    parser.add_argument("--output", help="save results as JSON to this file")
+    parser.add_argument("--compare", help="a previous results JSON file to compare with")
+    args = parser.parse_args(argv)
+
+    baselines = {}
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            for run in json.load(f)["runs"]:
+                baselines[run["businesses"]] = run
+
+    runs = []
+    for n in args.businesses:
+        run = run_benchmark(n, args.cities, args.figure_cities, args.seed)
+        print_run(run, baselines.get(n))
+        runs.append(run)
+
+    if args.output:
+        results = {"meta": {"python": sys.version.split()[0],
+                            "platform": platform.platform(),
+                            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                            "args": vars(args)},
+                   "runs": runs}
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+''' Fetch the cafes of many cities within the yelp daily quota.
+
+The cities to fetch are saved in a checkpoint file. Each run fetches the
+pending cities until fewer than --reserve calls plus the calls of one
+city (one per search term) are left today, or until yelp reports the
+quota used up, then saves the checkpoint. Running it again
+(e.g. the next day) resumes from the checkpoint. Cities already in the
+cache don't use any call.
+
+Usage:
+
+    $ python fetch_job.py --states michigan ohio
+    $ python fetch_job.py --all-states --reserve 100
+    $ python fetch_job.py                      # resume job.json
+'''
+
+import argparse
+import json
+import math
+import time
+
+import final_project as fp
+
+JOB_FILE_NAME = 'job.json'
+
+
+def load_job(job_file):
+    ''' Opens the checkpoint file if it exists
+
+    Parameters
+    ----------
+    job_file: string
+        path of the checkpoint file
+
+    Returns
+    -------
+    dict
+        the job with "pending" and "done" city lists, or None
+    '''
+    try:
+        f = open(job_file, 'r')
+        job = json.loads(f.read())
+        f.close()
+    except:
+        job = None
+    return job
+
+
+def save_job(job, job_file):
+    ''' Saves the checkpoint of the job to disk
+
+    Parameters
+    ----------
+    job: dict
+        the job
+    job_file: string
+        path of the checkpoint file
+    '''
+    f = open(job_file, 'w')
+    f.write(json.dumps(job, indent=2))
+    f.close()
+
+
+def new_job(states_and_cities, states):
+    ''' make a job fetching every city of some states
+
+    Parameters
+    ----------
+    states_and_cities: dict
+        The dict of states, the key is state's name, the values are selected cities
+    states: list
+        state names, lower case
+
+    Returns
+    -------
+    dict
+        the job, every [city, state] pending
+    '''
+    pending = []
+    for state in states:
+        for city in states_and_cities[state]:
+            if [city, state] not in pending:
+                pending.append([city, state])
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "pending": pending, "done": []}
+
+
+def run_job(job, job_file, reserve=0, interval=0.0):
+    ''' fetch pending cities of the job while quota is left, saving
+    the checkpoint after every city. A city yelp answers an error for
+    is moved to the "failed" list. Cities of jobs saved before their
+    state was kept are plain names, and synced without a state.
+
+    Parameters
+    ----------
+    job: dict
+        the job
+    job_file: string
+        path of the checkpoint file
+    reserve: int
+        calls to leave unused today, e.g. for the interactive program.
+        A city uses one call per term of fp.SEARCH_TERMS.
+    interval: float
+        seconds to wait after every city, to spread the calls
+
+    Returns
+    -------
+    int
+        number of cities fetched in this run
+    '''
+    fetched = 0
+    while len(job["pending"]) > 0:
+        if fp.remaining_quota() < reserve + len(fp.SEARCH_TERMS):
+            break
+        city = job["pending"][0]
+        if isinstance(city, list):
+            name, state = city
+        else:
+            name, state = city, None
+        try:
+            fp.fetch_city_businesses(name, state=state)
+        except fp.QuotaExceededError:
+            break
+        except fp.YelpApiError:
+            job["pending"].pop(0)
+            job.setdefault("failed", []).append(city)
+            save_job(job, job_file)
+            continue
+        job["pending"].pop(0)
+        job["done"].append(city)
+        save_job(job, job_file)
+        fetched += 1
+        if interval > 0:
+            time.sleep(interval)
+    return fetched
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch many cities within the yelp daily quota.")
+    parser.add_argument("--states", nargs="+", help="start a new job for these states")
+    parser.add_argument("--all-states", action="store_true", help="start a new job for every state")
+    parser.add_argument("--job", default=JOB_FILE_NAME, help="checkpoint file of the job")
+    parser.add_argument("--reserve", type=int, default=0, help="calls to leave unused today")
+    parser.add_argument("--interval", type=float, default=0.2,
+                        help="seconds to wait between cities")
+    args = parser.parse_args(argv)
+
+    fp.CACHE_DICT = fp.load_cache()
+    if args.states or args.all_states:
+        states_and_cities = fp.build_state_cities_dict()
+        fp.save_city_table(states_and_cities)
+        if args.all_states:
+            states = list(states_and_cities.keys())
+        else:
+            states = [e.lower() for e in args.states]
+            for state in states:
+                if state not in states_and_cities:
+                    parser.error("unknown state %s" % state)
+        job = new_job(states_and_cities, states)
+        save_job(job, args.job)
+    else:
+        job = load_job(args.job)
+        if job is None:
+            parser.error("no job in %s, pass --states or --all-states" % args.job)
+
+    budget = fp.remaining_quota() - args.reserve
+    calls_per_city = len(fp.SEARCH_TERMS)
+    cities_today = max(budget, 0) // calls_per_city
+    print("%s cities pending, %s calls to spend today (%s calls per city)" % (
+        len(job["pending"]), max(budget, 0), calls_per_city))
+    if len(job["pending"]) > cities_today > 0:
+        print("The job needs about %s days of quota." % math.ceil(len(job["pending"]) / cities_today))
+
+    fetched = run_job(job, args.job, args.reserve, args.interval)
+    print("%s cities fetched, %s done, %s pending, %s failed" % (
+        fetched, len(job["done"]), len(job["pending"]), len(job.get("failed", []))))
+    if len(job["pending"]) > 0:
+        print("Quota used up, run again to resume from %s." % args.job)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,13 @@
 ##### Uniqname: jiadongc ########
 #################################
 
+import atexit
+import collections
+import hashlib
+import os
+import threading
+import time
+import concurrent.futures
 import requests
 import json
 import sqlite3
@@ -11,12 +18,47 @@ from bs4 import BeautifulSoup
 import secrets
 import plotly.graph_objs as go
 import plotly.figure_factory as ff
+from plotly.subplots import make_subplots
+import metrics
+from search_index import SearchIndex
 
 yelp_api_key = secrets.API_KEY
 mapbox_token = secrets.MAPBOX_TOKEN
 headers = {"Authorization": "Bearer " + yelp_api_key}
 CACHE_FILE_NAME = 'cache.json'
+DB_NAME = 'final_project_db.sqlite'
+BUSINESS_COLUMNS = ["Name", "City", "CityId", "Address", "Latitude", "Longitude",
+                    "Price", "Image_url", "Rating", "Review_number", "YelpId", "Terms"]
+SEARCH_TERMS = ["coffee", "tea", "bakery"]
+FRESHNESS_SECONDS = 7 * 24 * 60 * 60
+QUOTA_FILE_NAME = 'quota.json'
+DAILY_QUOTA = 5000
 CACHE_DICT = {}
+CACHE_LOCK = threading.Lock()
+QUOTA_LOCK = threading.Lock()
+API_CALLS_IN_FLIGHT = {"count": 0}
+THROTTLE_RETRY_SECONDS = [1, 2, 4]
+CAFE_INDEX = {"version": None, "index": None}
+DATASET_COLUMNS = ["Name", "City", "Address", "Latitude", "Longitude",
+                   "Price", "Rating", "Review_number"]
+DATASET_CACHE = collections.OrderedDict()
+DATASET_CACHE_SIZE = 16
+DATASET_LOCK = threading.Lock()
+DATASET_GENERATION = {"count": 0}
+BUSINESSES_VERSIONS = {}
+PRICE_LABELS = ["level 1", "level 2", "level 3", "level 4", "no price information"]
+PRICE_COLORS = ["#4575b4", "#91bfdb", "#fee090", "#d73027", "#bdbdbd"]
+
+
+class YelpApiError(Exception):
+    '''raised when yelp answers an error instead of businesses, e.g. a
+    non-2xx status or a body with an "error" key'''
+
+
+class QuotaExceededError(YelpApiError):
+    '''raised instead of sending a yelp api request when the daily quota
+    is used up, or when yelp answers that it is (status 429 with
+    ACCESS_LIMIT_REACHED or no calls remaining)'''
 
 
 def construct_unique_key(baseurl, params):
@@ -44,8 +86,157 @@ def construct_unique_key(baseurl, params):
     return key_str
 
 
+def load_quota():
+    ''' Opens the quota file if it exists and loads today's yelp api
+    call accounting. The calls start from 0 again on a new (UTC) day.
+
+    Returns
+    -------
+    dict
+        "date", "calls" made today, "daily_limit", and "remaining" and
+        "reset_time" as read from the last response headers (or None)
+    '''
+    today = time.strftime("%Y-%m-%d", time.gmtime())
+    try:
+        quota_file = open(QUOTA_FILE_NAME, 'r')
+        quota = json.loads(quota_file.read())
+        quota_file.close()
+    except:
+        quota = {}
+    if quota.get("date") != today:
+        quota = {"date": today, "calls": 0,
+                 "daily_limit": quota.get("daily_limit", DAILY_QUOTA),
+                 "remaining": None, "reset_time": None}
+    return quota
+
+
+def save_quota(quota):
+    ''' Saves the yelp api call accounting to disk
+
+    Parameters
+    ----------
+    quota: dict
+        The quota from load_quota
+    '''
+    quota_file = open(QUOTA_FILE_NAME, 'w')
+    quota_file.write(json.dumps(quota))
+    quota_file.close()
+
+
+def remaining_quota():
+    ''' give the number of yelp api calls left today, the smaller of the
+    calls not made out of the daily limit and what yelp last reported,
+    less the calls sent since then that have not been answered yet
+
+    Returns
+    -------
+    int
+        calls left today
+    '''
+    quota = load_quota()
+    remaining = quota["daily_limit"] - quota["calls"]
+    if quota["remaining"] is not None:
+        remaining = min(remaining, quota["remaining"] - API_CALLS_IN_FLIGHT["count"])
+    return max(remaining, 0)
+
+
+def reserve_api_call():
+    ''' count one yelp api call before it is sent, so that threads
+    sending at the same time can not spend the same last call
+
+    Raises
+    ------
+    QuotaExceededError
+        if no yelp api call is left today
+    '''
+    with QUOTA_LOCK:
+        if remaining_quota() <= 0:
+            raise QuotaExceededError("yelp daily quota is used up")
+        quota = load_quota()
+        quota["calls"] += 1
+        save_quota(quota)
+        API_CALLS_IN_FLIGHT["count"] += 1
+
+
+def yelp_error_code(result):
+    ''' give the code of a yelp error body, e.g. "ACCESS_LIMIT_REACHED"
+
+    Parameters
+    ----------
+    result: dict
+        the api result, or None
+
+    Returns
+    -------
+    str
+        the error code, or None
+    '''
+    if not isinstance(result, dict) or not isinstance(result.get("error"), dict):
+        return None
+    return result["error"].get("code")
+
+
+def record_api_call(response, result=None):
+    ''' keep the rate-limit headers of the response to a call counted
+    by reserve_api_call. A 429 uses up the daily quota only when yelp
+    says so, not when it is throttling calls per second.
+
+    Parameters
+    ----------
+    response: requests.Response
+        the api response, or None if no response came
+    result: dict
+        the api result, or None
+    '''
+    with QUOTA_LOCK:
+        API_CALLS_IN_FLIGHT["count"] -= 1
+        if response is None:
+            return
+        quota = load_quota()
+        try:
+            quota["daily_limit"] = int(float(response.headers["RateLimit-DailyLimit"]))
+        except:
+            pass
+        try:
+            quota["remaining"] = int(float(response.headers["RateLimit-Remaining"]))
+        except:
+            pass
+        quota["reset_time"] = response.headers.get("RateLimit-ResetTime", quota["reset_time"])
+        if response.status_code == 429 and yelp_error_code(result) == "ACCESS_LIMIT_REACHED":
+            quota["remaining"] = 0
+        save_quota(quota)
+
+
+def is_daily_limit_reached(response, result):
+    ''' check if a 429 answer means the daily quota is used up, rather
+    than too many calls per second
+
+    Parameters
+    ----------
+    response: requests.Response
+        the api response
+    result: dict
+        the api result, or None
+
+    Returns
+    -------
+    bool
+        True if the error code is ACCESS_LIMIT_REACHED or no call remains
+    '''
+    if yelp_error_code(result) == "ACCESS_LIMIT_REACHED":
+        return True
+    try:
+        return int(float(response.headers["RateLimit-Remaining"])) <= 0
+    except:
+        return False
+
+
 def make_api_request(baseurl, params):
-    '''Make a request to the Web API using the baseurl and params
+    '''Make a request to the Web API using the baseurl and params.
+    Raise QuotaExceededError if no yelp api call is left today, and
+    YelpApiError if yelp answers an error, so that it is never cached.
+    A request throttled per second (429) is sent again after waiting
+    each of THROTTLE_RETRY_SECONDS.
 
     Parameters
     ----------
@@ -60,14 +251,39 @@ def make_api_request(baseurl, params):
         the data returned from making the request in the form of
         a dictionary
     '''
-    response = requests.get(baseurl, headers=headers, params=params)
-    return response.json()
+    for delay in THROTTLE_RETRY_SECONDS + [None]:
+        reserve_api_call()
+        try:
+            with metrics.Timer("http_request_seconds", kind="api"):
+                response = requests.get(baseurl, headers=headers, params=params)
+        except:
+            record_api_call(None)
+            raise
+        metrics.inc("http_requests_total", kind="api", status=response.status_code)
+        try:
+            result = response.json()
+        except ValueError:
+            result = None
+        record_api_call(response, result)
+        if response.status_code != 429:
+            break
+        if is_daily_limit_reached(response, result):
+            raise QuotaExceededError("yelp answered too many requests today")
+        if delay is None:
+            raise YelpApiError("yelp answered too many requests per second")
+        metrics.inc("api_throttled_total")
+        time.sleep(delay)
+    if not 200 <= response.status_code < 300 or not isinstance(result, dict) or "error" in result:
+        error = try_buss(result, "error") if isinstance(result, dict) else ""
+        raise YelpApiError("yelp answered status %s %s" % (response.status_code, error))
+    return result
 
 
-def make_api_request_with_cache(baseurl, params):
+def make_api_request_with_cache(baseurl, params, refresh=False):
     '''Check the cache for a saved result for this baseurl+params:values
     combo. If the result is found, return it. Otherwise send a new
-    request, save it, then return it.
+    request, save it with the time it was fetched in "fetched_at",
+    then return it.
 
     Parameters
     ----------
@@ -75,6 +291,8 @@ def make_api_request_with_cache(baseurl, params):
         The URL for the API endpoint
     params: dict
         The parameters to search for
+    refresh: bool
+        send a new request even if the result is in the cache
 
     Returns
     -------
@@ -83,18 +301,23 @@ def make_api_request_with_cache(baseurl, params):
         JSON
     '''
     key_str = construct_unique_key(baseurl, params)
-    if key_str in CACHE_DICT:
+    if key_str in CACHE_DICT and not refresh and "error" not in CACHE_DICT[key_str]:
         print("Using Cache")
+        metrics.inc("cache_hits_total", kind="api")
         return CACHE_DICT[key_str]
     else:
         print("Fetching")
-        CACHE_DICT[key_str] = make_api_request(baseurl, params)
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[key_str]
+        metrics.inc("cache_misses_total", kind="api")
+        result = make_api_request(baseurl, params)
+        result["fetched_at"] = time.time()
+        with CACHE_LOCK:
+            CACHE_DICT[key_str] = result
+            save_cache(CACHE_DICT)
+        return result
 
 
-def get_yelp_bussiness_search(city_name, term="coffee"):
-    ''' search for cafes bussiness information in a city
+def yelp_search_request(city_name, term="coffee", state=None):
+    ''' make the url and parameters of the yelp search of a term in a city
 
     Parameters
     ----------
@@ -102,20 +325,162 @@ def get_yelp_bussiness_search(city_name, term="coffee"):
         name of a city
     term: string
         term to search
+    state: string
+        the state of the city, searched as "city, state". None to
+        search the city name alone.
 
     Returns
     -------
-    dict
-        query information dict
+    tuple
+        (url, params dict)
     '''
     yelp_url = "https://api.yelp.com/v3/businesses/search"
-    params = {"location": city_name,
+    if state:
+        location = "%s, %s" % (city_name, state)
+    else:
+        location = city_name
+    params = {"location": location,
               "term": term,
               "limit": 50}
-    yelp_business_dict = make_api_request_with_cache(yelp_url, params)
+    return yelp_url, params
+
+
+def is_search_cached(city_name, terms=SEARCH_TERMS, state=None):
+    ''' check that the search results of every term of a city are in the
+    cache, so that get_yelp_multi_term_search sends no request
+
+    Parameters
+    ----------
+    city_name: string
+        name of a city
+    terms: list
+        terms to search, e.g. ["coffee", "tea"]
+    state: string
+        the state of the city, see yelp_search_request
+
+    Returns
+    -------
+    bool
+        True if every result is cached and not an error
+    '''
+    for term in terms:
+        key_str = construct_unique_key(*yelp_search_request(city_name, term, state))
+        if key_str not in CACHE_DICT or "error" in CACHE_DICT[key_str]:
+            return False
+    return True
+
+
+def get_yelp_bussiness_search(city_name, term="coffee", refresh=False, state=None):
+    ''' search for cafes bussiness information in a city
+
+    Parameters
+    ----------
+    city_name: string
+        name of a city
+    term: string
+        term to search
+    refresh: bool
+        search again even if the result is in the cache
+    state: string
+        the state of the city, see yelp_search_request
+
+    Returns
+    -------
+    dict
+        query information dict
+    '''
+    yelp_url, params = yelp_search_request(city_name, term, state)
+    yelp_business_dict = make_api_request_with_cache(yelp_url, params, refresh=refresh)
     return yelp_business_dict
 
 
+def is_buss_result(yelp_business_dict):
+    ''' check that an api result lists businesses and is not an error
+
+    Parameters
+    ----------
+    yelp_business_dict: dict
+        businesses dict from api query
+
+    Returns
+    -------
+    bool
+        True if it has a "businesses" list and no "error"
+    '''
+    return isinstance(yelp_business_dict, dict) and "error" not in yelp_business_dict \
+        and isinstance(yelp_business_dict.get("businesses"), list)
+
+
+def merge_yelp_results(results_by_term):
+    ''' merge the api results of several terms in one pass, keeping each
+    business once (by yelp id, or by name and address without an id)
+    and tagging it with the terms it matched in "matched_terms"
+
+    Parameters
+    ----------
+    results_by_term: dict
+        key is a term, value is the businesses dict of its api query
+
+    Returns
+    -------
+    dict
+        businesses dict like an api result, with the merged "businesses",
+        their "total", the "terms", and "fetched_at", the time the oldest
+        result was fetched (0 if a result was cached without it)
+
+    Raises
+    ------
+    YelpApiError
+        if the result of a term has no "businesses", e.g. an error
+    '''
+    merged = {}
+    for term in results_by_term:
+        if not is_buss_result(results_by_term[term]):
+            raise YelpApiError("no businesses in the yelp result of %s" % term)
+        for bu in results_by_term[term]["businesses"]:
+            key = try_buss(bu, "id") or (try_buss(bu, "name"),
+                                         try_buss(try_buss(bu, "location"), "address1"))
+            if key not in merged:
+                merged[key] = dict(bu, matched_terms=[])
+            if term not in merged[key]["matched_terms"]:
+                merged[key]["matched_terms"].append(term)
+    businesses = list(merged.values())
+    fetched_at = min([try_buss(r, "fetched_at") or 0 for r in results_by_term.values()] or [0])
+    return {"businesses": businesses, "total": len(businesses),
+            "terms": list(results_by_term.keys()), "fetched_at": fetched_at}
+
+
+def get_yelp_multi_term_search(city_name, terms=SEARCH_TERMS, refresh=False, state=None):
+    ''' search bussiness information in a city for several terms at the
+    same time, and merge the results with merge_yelp_results
+
+    Parameters
+    ----------
+    city_name: string
+        name of a city
+    terms: list
+        terms to search, e.g. ["coffee", "tea"]
+    refresh: bool
+        search again even if the results are in the cache
+    state: string
+        the state of the city, see get_yelp_bussiness_search
+
+    Returns
+    -------
+    dict
+        merged query information dict
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(terms)) as executor:
+        futures = {}
+        for term in terms:
+            futures[term] = executor.submit(get_yelp_bussiness_search, city_name, term,
+                                            refresh, state)
+        results_by_term = {}
+        for term in terms:
+            results_by_term[term] = futures[term].result()
+    return merge_yelp_results(results_by_term)
+
+
 def scrape_state_url():
     ''' scrape states and cities' url from the url. (crawling)
 
@@ -181,11 +546,15 @@ def make_url_request_using_cache(url, cache):
     '''
     if url in list(cache.keys()):  # the url is our unique key
         print("Using Cache")
+        metrics.inc("cache_hits_total", kind="url")
         return cache[url]
     else:
         print("Fetching")
+        metrics.inc("cache_misses_total", kind="url")
         # print(url)
-        response = requests.get(url)
+        with metrics.Timer("http_request_seconds", kind="url"):
+            response = requests.get(url)
+        metrics.inc("http_requests_total", kind="url", status=response.status_code)
         cache[url] = response.text
         save_cache(cache)
         return cache[url]  # in both cases, we return cache[url]
@@ -225,8 +594,28 @@ def save_cache(cache):
     cache_file.close()
 
 
+def create_city_table(cur, if_not_exists=True):
+    ''' create the Cities table
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        cursor of the database
+    if_not_exists: bool
+        if False, raise sqlite3.OperationalError when the table exists
+    '''
+    create_city_table = '''
+        CREATE TABLE %s "Cities" (
+            "Id"        INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
+            "City"  TEXT NOT NULL,
+            "State" TEXT NOT NULL
+        );
+    ''' % ("IF NOT EXISTS" if if_not_exists else "")
+    cur.execute(create_city_table)
+
+
 def save_city_table(states_and_cities):
-    ''' Save cities into database
+    ''' Save cities into database, unless the Cities table already exists
 
     Parameters
     ----------
@@ -234,16 +623,9 @@ def save_city_table(states_and_cities):
         The dict of states, the key is state's name, the values are selected cities
     '''
     try:
-        create_city_table = '''
-            CREATE TABLE "Cities" (
-                "Id"        INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
-                "City"  TEXT NOT NULL,
-                "State" TEXT NOT NULL
-            );
-        '''
-        conn = sqlite3.connect("final_project_db.sqlite")
+        conn = sqlite3.connect(DB_NAME)
         cur = conn.cursor()
-        cur.execute(create_city_table)
+        create_city_table(cur, if_not_exists=False)
         add_city = "INSERT INTO Cities VALUES (NULL, ?, ?)"
         for state in states_and_cities:
             for city in states_and_cities[state]:
@@ -253,6 +635,40 @@ def save_city_table(states_and_cities):
         return None
 
 
+def create_business_table(cur):
+    ''' create the Businesses table if it doesn't exist. Tables made before
+    the YelpId or Terms column existed get the column added.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        cursor of the database
+    '''
+    create_business_table = '''
+            CREATE TABLE IF NOT EXISTS "Businesses" (
+                "Id"        INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
+                "Name"  TEXT NOT NULL,
+                "City" TEXT NOT NULL,
+                "CityId" INTEGER NOT NULL,
+                "Address" TEXT NOT NULL,
+                "Latitude" REAL,
+                "Longitude" REAL,
+                "Price" TEXT NOT NULL,
+                "Image_url" TEXT NOT NULL,
+                "Rating" REAL,
+                "Review_number" INTEGER,
+                "YelpId" TEXT,
+                "Terms" TEXT,
+                FOREIGN KEY (CityId) REFERENCES Cities (Id)
+            );
+        '''
+    cur.execute(create_business_table)
+    columns = [row[1] for row in cur.execute('PRAGMA table_info("Businesses")').fetchall()]
+    for column in ["YelpId", "Terms"]:
+        if column not in columns:
+            cur.execute('ALTER TABLE Businesses ADD COLUMN "%s" TEXT' % column)
+
+
 class Business():
     '''a business
 
@@ -287,10 +703,17 @@ class Business():
 
     review_count: int
         review number of the business
+
+    yelp_id: string
+        yelp business id of the business
+
+    terms: string
+        comma separated search terms the business matched
     '''
     def __init__(self, name=None, city=None, address=None,
                  lat=None, lon=None, zipcode=None, price=None,
-                 image_url=None, rating=None, review_count=None):
+                 image_url=None, rating=None, review_count=None,
+                 yelp_id=None, terms=None, save=True):
         self.name = name
         self.city = city
         self.address = address
@@ -301,17 +724,21 @@ class Business():
         self.image_url = image_url
         self.rating = rating
         self.review_count = review_count
-        self.save_business_table() #automatically save the business in table
+        self.yelp_id = yelp_id
+        self.terms = terms
+        if save:
+            self.save_business_table() #automatically save the business in table
 
     def info(self):
         '''return the business information'''
         return self.name + "(%s,%s)" % (
         self.rating, self.price) + ": " + self.address + ", " + self.city + ", " + self.zipcode
 
+    @metrics.timed("sql_seconds", op="save_business_table")
     def save_business_table(self):
         ''' Save the business into database
         '''
-        conn = sqlite3.connect("final_project_db.sqlite")
+        conn = sqlite3.connect(DB_NAME)
         cur = conn.cursor()
         query = '''SELECT Id FROM Cities WHERE Cities.City= "%s"''' % self.city
         result = cur.execute(query).fetchall()
@@ -320,31 +747,19 @@ class Business():
             cityId = ""
         else:
             cityId = result[0][0]
-        create_business_table = '''
-                CREATE TABLE IF NOT EXISTS "Businesses" (
-                    "Id"        INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
-                    "Name"  TEXT NOT NULL,
-                    "City" TEXT NOT NULL,
-                    "CityId" INTEGER NOT NULL,
-                    "Address" TEXT NOT NULL,
-                    "Latitude" REAL,
-                    "Longitude" REAL,
-                    "Price" TEXT NOT NULL,
-                    "Image_url" TEXT NOT NULL,
-                    "Rating" REAL,
-                    "Review_number" INTEGER,
-                    FOREIGN KEY (CityId) REFERENCES Cities (Id)
-                );
-            '''
-        conn = sqlite3.connect("final_project_db.sqlite")
+        conn = sqlite3.connect(DB_NAME)
         cur = conn.cursor()
-        cur.execute(create_business_table)
-        add_business = "INSERT INTO Businesses VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        create_business_table(cur)
+        add_business = "INSERT INTO Businesses (%s) VALUES (%s)" % (
+            ", ".join(BUSINESS_COLUMNS), ", ".join(["?"] * len(BUSINESS_COLUMNS)))
         info_list = [self.name, self.city, cityId, self.address + ", " + self.zipcode,
                      self.lat, self.lon, self.price, self.image_url,
-                     self.rating, self.review_count]
+                     self.rating, self.review_count, self.yelp_id, self.terms]
         cur.execute(add_business, info_list)
+        bump_businesses_version(cur)
         conn.commit()
+        invalidate_city_dataset(self.city)
+        metrics.inc("db_rows_written_total", table="Businesses")
 
 
 def try_buss(dic, key):
@@ -368,8 +783,9 @@ def try_buss(dic, key):
         return ""
 
 
-def build_buss_objs_from_dict(user_city, yelp_business_dict):
-    ''' build Business objects from a list of api businesses information
+def parse_buss_attrs(user_city, yelp_business_dict):
+    ''' pick out the Business attributes of the api businesses located in
+    user_city, without saving anything into database
 
     Parameters
     ----------
@@ -381,9 +797,9 @@ def build_buss_objs_from_dict(user_city, yelp_business_dict):
     Returns
     -------
     list
-        list of Businesses objects
+        list of attribute lists, in the order of Business arguments
     '''
-    buss_objs = []
+    attr_lists = []
     for bu in yelp_business_dict["businesses"]:
         if user_city.lower() == try_buss(try_buss(bu, "location"), "city").lower():
             attr_list = []
@@ -397,132 +813,853 @@ def build_buss_objs_from_dict(user_city, yelp_business_dict):
             attr_list.append(try_buss(bu, "image_url"))
             attr_list.append(try_buss(bu, "rating"))
             attr_list.append(try_buss(bu, "review_count"))
-            buss_objs.append(Business(*attr_list))
-    return buss_objs
+            attr_list.append(try_buss(bu, "id"))
+            attr_list.append(",".join(try_buss(bu, "matched_terms")))
+            attr_lists.append(attr_list)
+    return attr_lists
 
 
-def get_busi_db_info(props, params=None):
-    ''' get business information from database
+def build_buss_objs_from_dict(user_city, yelp_business_dict, save=False):
+    ''' build Business objects from a list of api businesses information
 
     Parameters
     ----------
-    props: list
-        a list of property strings to query, e.g. ["rating"]
-    params: dict
-        parameters pass into database query, e.g. {"city":"Ann Arbor"}
+    user_city: string
+        a city name
+    yelp_business_dict: dict
+        businesses dict from api query
+    save: bool
+        whether each Business is inserted into database, as a new row
+        even if it is there already. Use sync_city_businesses to save
+        the businesses of a city.
 
     Returns
     -------
     list
-        Business property information that meets the parameters
+        list of Businesses objects
+    '''
+    buss_objs = []
+    for attr_list in parse_buss_attrs(user_city, yelp_business_dict):
+        buss_objs.append(Business(*attr_list, save=save))
+    return buss_objs
+
+
+def create_refresh_table(cur):
+    ''' create the CityRefresh table if it doesn't exist. It keeps, for each
+    city and state, how many times the city is used, when it was last
+    fetched and the fingerprint of the last fetched businesses. The state
+    is "" for a city used without its state. Tables made when cities were
+    keyed by name only are copied into the new table, with the state
+    they kept, if any.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        cursor of the database
+    '''
+    create_refresh_table = '''
+            CREATE TABLE IF NOT EXISTS "CityRefresh" (
+                "City"  TEXT NOT NULL,
+                "Uses" INTEGER NOT NULL DEFAULT 0,
+                "LastFetch" REAL,
+                "Fingerprint" TEXT,
+                "State" TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (City, State)
+            );
+        '''
+    cur.execute(create_refresh_table)
+    columns = cur.execute('PRAGMA table_info("CityRefresh")').fetchall()
+    if [row[1] for row in columns if row[5] > 0] == ["City"]:
+        state = '"State"' if "State" in [row[1] for row in columns] else "NULL"
+        cur.execute('ALTER TABLE CityRefresh RENAME TO CityRefreshByName')
+        cur.execute(create_refresh_table)
+        cur.execute('''INSERT INTO CityRefresh (City, Uses, LastFetch, Fingerprint, State)
+                       SELECT City, Uses, LastFetch, Fingerprint, COALESCE(%s, '')
+                       FROM CityRefreshByName''' % state)
+        cur.execute('DROP TABLE CityRefreshByName')
+        cur.connection.commit()
+
+
+def refresh_state(state):
+    ''' give the CityRefresh state of a state name, "" if it is None '''
+    if state is None:
+        return ""
+    return state.lower()
+
+
+def record_city_use(user_city, state=None):
+    ''' add one to the number of times a city is used
+
+    Parameters
+    ----------
+    user_city: string
+        a city name
+    state: string
+        the state of the city, None if it is not known
     '''
-    conn = sqlite3.connect("final_project_db.sqlite")
+    conn = sqlite3.connect(DB_NAME)
     cur = conn.cursor()
-    real_props = ""
-    for i in range(len(props)):
-        real_props += "b.{}".format(props[i]) + ", "
-    real_props = real_props[:-2]
-    command = '''SELECT {} FROM Businesses as b'''.format(real_props)
-    if params != None:
-        keys = list(params.keys())
-        for key in keys:
-            if keys.index(key) == 0:
-                command += ' WHERE {}="{}"'.format(key, params[key])
-            else:
-                command += ' AND {}="{}"'.format(key, params[key])
-    command += ";"
-    result = cur.execute(command).fetchall()
+    create_refresh_table(cur)
+    cur.execute('''INSERT INTO CityRefresh (City, State, Uses) VALUES (?, ?, 1)
+                   ON CONFLICT(City, State) DO UPDATE SET Uses = Uses + 1''',
+                (user_city, refresh_state(state)))
+    conn.commit()
     conn.close()
-    return result
 
 
-def get_aver_info_db(props_str, params=None):
-    ''' give the average info of cafes of a city
+def get_last_fetch(user_city, state=None):
+    ''' get the time a city was last fetched and synced into database
 
     Parameters
     ----------
-    props_str: string
-        property string to calculate info, e.g. "rating"
-    params: dict
-        parameters pass into database query, e.g. {"city":"Ann Arbor"}
+    user_city: string
+        a city name
+    state: string
+        the state of the city, None if it is not known
 
     Returns
     -------
-    string
-        average rating
+    float
+        seconds since the epoch, or None if the city was never synced
     '''
-    result = get_busi_db_info([props_str], params=params)
-    result = [e[0] for e in result]
-    aver_info = sum(result) / len(result)
-    res = "*" * len("Average %s of the city is %s" % (props_str, aver_info))
-    res += "\n"
-    res += "Average %s of %s city is %s" % (props_str, params["City"], aver_info)
-    res += "\n"
-    res += "*" * len("Average %s of the city is %s" % (props_str, aver_info))
-    return res
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    create_refresh_table(cur)
+    result = cur.execute("SELECT LastFetch FROM CityRefresh WHERE City = ? AND State = ?",
+                         (user_city, refresh_state(state))).fetchall()
+    conn.close()
+    if len(result) == 0:
+        return None
+    return result[0][0]
 
 
-def get_best_busi_based_on_rating_review(params=None):
-    ''' give the best cafe of a city based on highest rating,
-    then highest review numbers
+def buss_fingerprint(attr_lists):
+    ''' make a fingerprint of businesses, which only changes when a business
+    is added, removed or has a changed attribute
 
     Parameters
     ----------
-    params: dict
-        parameters pass into database query, e.g. {"city":"Ann Arbor"}
+    attr_lists: list
+        list of attribute lists from parse_buss_attrs
 
     Returns
     -------
     string
-        name and address of best cafe.
+        sha1 hex digest
     '''
-    result = get_busi_db_info(["rating", "review_number",
-                               "Name", "City", "Address"], params=params)
-    result = sorted(result, key=lambda x: (x[0], x[1]), reverse=True)
-    result_str = "*" * 40 + "\n"
-    result_str += "The best coffee we recommend: \n" \
-                  "{}: {}, \n" \
-                  "rating: {}, review number: {} " \
-                  "".format(result[0][2], result[0][3] + ", " + result[0][4], result[0][0], result[0][1])
-    result_str += "\n" + "*" * 40
-    return result_str
+    rows = sorted(json.dumps(a) for a in attr_lists)
+    return hashlib.sha1("\n".join(rows).encode("utf-8")).hexdigest()
 
 
-def input_state_name(states_and_cities):
-    ''' interactive: let user input a choice from "exit" or valid name of a state.
-    When get a invalid input, input operation will be required until get a valid one.
-    When get "exit", the program exits.
+def sync_city_businesses(user_city, yelp_business_dict, state=None):
+    ''' bring the Businesses rows of a city in line with an api result,
+    writing only the inserted, updated and deleted businesses.
+    Only the rows of the city with its CityId are touched, so cities
+    of the same name in other states keep their rows.
+    Businesses are matched by yelp id, or by name and address for rows
+    saved without a yelp id. Duplicated rows of a business are deleted.
+    The LastFetch of the city is the "fetched_at" of the result, or now
+    if it has none.
 
     Parameters
     ----------
-    states_and_cities: dict
-        The dict of states, the key is state's name, the values are selected cities
+    user_city: string
+        a city name
+    yelp_business_dict: dict
+        businesses dict from api query
+    state: string
+        the state of the city, which picks its CityId when cities of
+        several states have its name. None for the first such city.
 
     Returns
     -------
-    string
-        a state's name
+    dict
+        numbers of "inserted", "updated" and "deleted" rows
+
+    Raises
+    ------
+    YelpApiError
+        if yelp_business_dict is an error, which would delete every row
     '''
-    states = list(states_and_cities.keys())
-    while True:
-        state_name = input('''Enter a state name (e.g. Michigan, michigan) or "exit": ''')
-        if state_name.lower() == "exit":
-            exit()
-        elif state_name.lower() not in states:
-            print("[Error] Enter proper state name")
-            print()
+    if not is_buss_result(yelp_business_dict):
+        raise YelpApiError("not syncing %s with a yelp error result" % user_city)
+    attr_lists = parse_buss_attrs(user_city, yelp_business_dict)
+    fingerprint = buss_fingerprint(attr_lists)
+    counts = {"inserted": 0, "updated": 0, "deleted": 0}
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    create_business_table(cur)
+    create_refresh_table(cur)
+    result = cur.execute("SELECT Fingerprint FROM CityRefresh WHERE City = ? AND State = ?",
+                         (user_city, refresh_state(state))).fetchall()
+    if len(result) == 0 or result[0][0] != fingerprint:
+        if state is None:
+            result = cur.execute("SELECT Id FROM Cities WHERE City = ?", (user_city,)).fetchall()
         else:
-            break
-    return state_name
+            result = cur.execute("SELECT Id FROM Cities WHERE City = ? AND State = ?",
+                                 (user_city, state.lower())).fetchall()
+        if len(result) == 0:
+            cityId = ""
+        else:
+            cityId = result[0][0]
+        new_rows = {}
+        keys_by_name_address = {}
+        for a in attr_lists:
+            row = (a[0], a[1], cityId, a[2] + ", " + a[5], a[3], a[4],
+                   a[6], a[7], a[8], a[9], a[10], a[11])
+            new_rows[a[10] or (row[0], row[3])] = row
+            keys_by_name_address[(row[0], row[3])] = a[10] or (row[0], row[3])
+        old_rows = {}
+        deletes = []
+        command = "SELECT Id, %s FROM Businesses WHERE City = ? COLLATE NOCASE AND CityId = ?" % (
+            ", ".join(BUSINESS_COLUMNS))
+        with metrics.Timer("sql_seconds", op="sync_city_businesses"):
+            for old in cur.execute(command, (user_city, cityId)).fetchall():
+                key = old[11] or keys_by_name_address.get((old[1], old[4]), (old[1], old[4]))
+                if key in new_rows and key not in old_rows:
+                    old_rows[key] = old
+                else:
+                    deletes.append((old[0],))
+            inserts = [row for key, row in new_rows.items() if key not in old_rows]
+            updates = [row + (old_rows[key][0],) for key, row in new_rows.items()
+                       if key in old_rows and tuple(old_rows[key][1:]) != row]
+            cur.executemany("INSERT INTO Businesses (%s) VALUES (%s)" % (
+                ", ".join(BUSINESS_COLUMNS), ", ".join(["?"] * len(BUSINESS_COLUMNS))), inserts)
+            cur.executemany("UPDATE Businesses SET %s WHERE Id = ?" % (
+                ", ".join(c + " = ?" for c in BUSINESS_COLUMNS)), updates)
+            cur.executemany("DELETE FROM Businesses WHERE Id = ?", deletes)
+        counts = {"inserted": len(inserts), "updated": len(updates), "deleted": len(deletes)}
+        for op in counts:
+            metrics.inc("db_rows_written_total", table="Businesses", op=op, value=counts[op])
+        if sum(counts.values()) > 0:
+            bump_businesses_version(cur)
+    cur.execute('''INSERT INTO CityRefresh (City, State, LastFetch, Fingerprint) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(City, State) DO UPDATE SET LastFetch = excluded.LastFetch,
+                   Fingerprint = excluded.Fingerprint''',
+                (user_city, refresh_state(state), yelp_business_dict.get("fetched_at", time.time()),
+                 fingerprint))
+    conn.commit()
+    conn.close()
+    if sum(counts.values()) > 0:
+        invalidate_city_dataset(user_city)
+    return counts
 
 
-def input_city_number(cities):
-    ''' interactive: let user input a choice from "exit" or valid number of cities number.
-    When get a invalid input, input operation will be required until get a valid one.
+def get_db_buss_result(user_city):
+    ''' make a businesses dict like an api result from the Businesses rows
+    of a city, e.g. for a fresh city whose result is not in the cache
 
     Parameters
-    -------
+    ----------
+    user_city: string
+        a city name
+
+    Returns
+    -------
+    dict
+        businesses dict with "businesses" and their "total"
+    '''
+    businesses = []
+    for row in get_busi_db_info(BUSINESS_COLUMNS, {"City": user_city}):
+        address, _, zip_code = row[3].rpartition(", ")
+        businesses.append({"id": row[10] or "", "name": row[0],
+                           "location": {"city": row[1], "address1": address,
+                                        "zip_code": zip_code},
+                           "coordinates": {"latitude": row[4], "longitude": row[5]},
+                           "price": row[6], "image_url": row[7], "rating": row[8],
+                           "review_count": row[9],
+                           "matched_terms": row[11].split(",") if row[11] else []})
+    return {"businesses": businesses, "total": len(businesses)}
+
+
+def fetch_city_businesses(user_city, freshness=FRESHNESS_SECONDS, state=None):
+    ''' get the api result of a city, fetching it again only if the city
+    was last fetched longer than freshness seconds ago, and sync the
+    Businesses table when it was (re)fetched. A stale city is kept as it
+    is when the quota is used up or yelp answers an error. A city that is
+    not fetched whose result is not in the cache, e.g. a fresh city after
+    a snapshot import, is listed from its Businesses rows, without any
+    request.
+
+    Parameters
+    ----------
+    user_city: string
+        a city name
+    freshness: float
+        seconds a fetched city stays fresh
+    state: string
+        the state of the city, searched with it and used by
+        sync_city_businesses. None if it is not known.
+
+    Returns
+    -------
+    dict
+        businesses dict from api query
+    '''
+    last_fetch = get_last_fetch(user_city, state)
+    if last_fetch is None:
+        yelp_business_dict = get_yelp_multi_term_search(user_city, state=state)
+        sync_city_businesses(user_city, yelp_business_dict, state)
+    elif time.time() - last_fetch > freshness:
+        try:
+            yelp_business_dict = get_yelp_multi_term_search(user_city, refresh=True, state=state)
+            sync_city_businesses(user_city, yelp_business_dict, state)
+        except YelpApiError:
+            if is_search_cached(user_city, state=state):
+                yelp_business_dict = get_yelp_multi_term_search(user_city, state=state)
+            else:
+                yelp_business_dict = get_db_buss_result(user_city)
+    elif is_search_cached(user_city, state=state):
+        yelp_business_dict = get_yelp_multi_term_search(user_city, state=state)
+    else:
+        metrics.inc("cache_misses_total", kind="fresh_city")
+        yelp_business_dict = get_db_buss_result(user_city)
+    return yelp_business_dict
+
+
+def load_city_businesses(user_city, freshness=FRESHNESS_SECONDS, state=None):
+    ''' count one use of a city, then get its api result with
+    fetch_city_businesses
+
+    Parameters
+    ----------
+    user_city: string
+        a city name
+    freshness: float
+        seconds a fetched city stays fresh
+    state: string
+        the state of the city, see fetch_city_businesses
+
+    Returns
+    -------
+    dict
+        businesses dict from api query
+    '''
+    record_city_use(user_city, state)
+    return fetch_city_businesses(user_city, freshness, state)
+
+
+def refresh_stale_cities(limit=None, freshness=FRESHNESS_SECONDS):
+    ''' fetch again the cities last fetched longer than freshness seconds
+    ago, or used but never fetched, the most used cities first, and sync
+    their Businesses rows.
+    Stop early when the yelp quota is used up. A city yelp answers an
+    error for is skipped, its rows kept as they are.
+
+    Parameters
+    ----------
+    limit: int
+        the most cities to fetch, None for all stale cities
+    freshness: float
+        seconds a fetched city stays fresh
+
+    Returns
+    -------
+    list
+        (city, counts dict from sync_city_businesses) of refreshed cities
+    '''
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    create_refresh_table(cur)
+    command = '''SELECT City, State FROM CityRefresh
+                 WHERE LastFetch IS NULL OR LastFetch < ?
+                 ORDER BY Uses DESC, LastFetch ASC'''
+    cities = cur.execute(command, (time.time() - freshness,)).fetchall()
+    conn.close()
+    if limit is not None:
+        cities = cities[:limit]
+    refreshed = []
+    for city, state in cities:
+        state = state or None
+        try:
+            yelp_business_dict = get_yelp_multi_term_search(city, refresh=True, state=state)
+        except QuotaExceededError:
+            break
+        except YelpApiError:
+            metrics.inc("refresh_errors_total")
+            continue
+        refreshed.append((city, sync_city_businesses(city, yelp_business_dict, state)))
+    return refreshed
+
+
+def get_busi_db_info(props, params=None, conn=None):
+    ''' get business information from database
+
+    Parameters
+    ----------
+    props: list
+        a list of property strings to query, e.g. ["rating"]
+    params: dict
+        parameters pass into database query, e.g. {"city":"Ann Arbor"}
+    conn: sqlite3.Connection
+        connection to query with, left open. If None, a connection to
+        DB_NAME is opened and closed.
+
+    Returns
+    -------
+    list
+        Business property information that meets the parameters
+    '''
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    real_props = ""
+    for i in range(len(props)):
+        real_props += "b.{}".format(props[i]) + ", "
+    real_props = real_props[:-2]
+    command = '''SELECT {} FROM Businesses as b'''.format(real_props)
+    values = []
+    if params != None:
+        keys = list(params.keys())
+        for key in keys:
+            if keys.index(key) == 0:
+                command += ' WHERE {}=?'.format(key)
+            else:
+                command += ' AND {}=?'.format(key)
+            values.append(params[key])
+    command += ";"
+    with metrics.Timer("sql_seconds", op="get_busi_db_info"):
+        result = cur.execute(command, values).fetchall()
+    if own_conn:
+        conn.close()
+    metrics.inc("db_rows_scanned_total", table="Businesses", value=len(result))
+    return result
+
+
+class CityDataset():
+    '''the cafes of a city, loaded from database in one query and shared
+    by every analysis and figure of the city
+
+    Instance Attributes
+    -------------------
+    city: string
+        the city name
+
+    columns: dict
+        key is a lower case column name of DATASET_COLUMNS, e.g. "rating",
+        value is the list of values of the cafes, in the same order
+
+    texts: list
+        hover text of each cafe, e.g. "Sweetwaters (Ann Arbor): 123 Main St,
+        48104, rating: 4.5"
+    '''
+    def __init__(self, city, rows):
+        self.city = city
+        self.columns = {}
+        for i in range(len(DATASET_COLUMNS)):
+            self.columns[DATASET_COLUMNS[i].lower()] = [row[i] for row in rows]
+        self.texts = ["{} ({}): {}, rating: {}".format(name, cafe_city, address, rating)
+                      for name, cafe_city, address, rating in zip(
+                          self["name"], self["city"], self["address"], self["rating"])]
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, column):
+        return self.columns[column.lower()]
+
+
+def db_file_path(conn=None):
+    ''' give the database file of a connection
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        connection to look at, DB_NAME if None
+
+    Returns
+    -------
+    string
+        absolute path of the file, or "" for an in-memory database
+    '''
+    if conn is None:
+        return os.path.abspath(DB_NAME)
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+def get_city_dataset(user_city, conn=None):
+    ''' give the dataset of a city, loading it from database only the first
+    time, or again after invalidate_city_dataset, or after another program
+    wrote the Businesses rows (see check_businesses_version). The
+    DATASET_CACHE_SIZE most recently used datasets are kept in memory. A dataset loaded
+    while datasets are invalidated is not kept, as it may be stale.
+
+    Parameters
+    ----------
+    user_city: string
+        a city name
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
+
+    Returns
+    -------
+    CityDataset
+        the cafes of the city
+    '''
+    path = db_file_path(conn)
+    key = (path, user_city)
+    if path:
+        check_businesses_version(conn)
+    with DATASET_LOCK:
+        if path and key in DATASET_CACHE:
+            DATASET_CACHE.move_to_end(key)
+            metrics.inc("dataset_cache_hits_total")
+            return DATASET_CACHE[key]
+        generation = DATASET_GENERATION["count"]
+    metrics.inc("dataset_cache_misses_total")
+    dataset = CityDataset(user_city, get_busi_db_info(DATASET_COLUMNS, {"City": user_city}, conn=conn))
+    with DATASET_LOCK:
+        if path and DATASET_GENERATION["count"] == generation:
+            DATASET_CACHE[key] = dataset
+            while len(DATASET_CACHE) > DATASET_CACHE_SIZE:
+                DATASET_CACHE.popitem(last=False)
+    return dataset
+
+
+def invalidate_city_dataset(user_city=None):
+    ''' forget the cached dataset of a city, e.g. after its businesses
+    were written, so that it is loaded again on next use. The cafe
+    index of get_cafe_index is built again too.
+
+    Parameters
+    ----------
+    user_city: string
+        a city name, ignoring case. If None, every dataset is forgotten.
+    '''
+    with DATASET_LOCK:
+        DATASET_GENERATION["count"] += 1
+        for key in list(DATASET_CACHE):
+            if user_city is None or key[1].lower() == user_city.lower():
+                del DATASET_CACHE[key]
+
+
+def bump_businesses_version(cur):
+    ''' add one to the version of the Businesses rows, kept in the
+    BusinessesVersion table, in the transaction that writes them. Every
+    program using the database sees the change in check_businesses_version.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        cursor of the database
+    '''
+    cur.execute('''CREATE TABLE IF NOT EXISTS "BusinessesVersion" (
+                       "Id" INTEGER PRIMARY KEY CHECK (Id = 0),
+                       "Version" INTEGER NOT NULL
+                   )''')
+    cur.execute('''INSERT INTO BusinessesVersion (Id, Version) VALUES (0, 1)
+                   ON CONFLICT(Id) DO UPDATE SET Version = Version + 1''')
+    version = cur.execute("SELECT Version FROM BusinessesVersion").fetchone()[0]
+    path = db_file_path(cur.connection)
+    with DATASET_LOCK:
+        if BUSINESSES_VERSIONS.get(path) == version - 1:
+            # this program's own write, invalidated by the writer
+            BUSINESSES_VERSIONS[path] = version
+
+
+def get_businesses_version(conn=None):
+    ''' get the version of the Businesses rows of a database
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
+
+    Returns
+    -------
+    int
+        the version, 0 if the rows were never written
+    '''
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(DB_NAME)
+    try:
+        result = conn.execute("SELECT Version FROM BusinessesVersion").fetchall()
+    except sqlite3.OperationalError:
+        result = []
+    if own_conn:
+        conn.close()
+    if len(result) == 0:
+        return 0
+    return result[0][0]
+
+
+def check_businesses_version(conn=None):
+    ''' forget every cached dataset and the cafe index when the Businesses
+    rows of a database were written since the last check, e.g. by
+    refresh.py or fetch_job.py while this program runs. Writes of the
+    CityRefresh table don't change the version.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
+    '''
+    if conn is None and not os.path.exists(DB_NAME):
+        return
+    path = db_file_path(conn)
+    version = get_businesses_version(conn)
+    with DATASET_LOCK:
+        seen = BUSINESSES_VERSIONS.get(path)
+        BUSINESSES_VERSIONS[path] = version
+    if seen is not None and seen != version:
+        metrics.inc("dataset_cache_external_writes_total")
+        invalidate_city_dataset()
+
+
+def city_params(params):
+    ''' give the city of query parameters selecting all cafes of a city,
+    which are answered from the city dataset
+
+    Parameters
+    ----------
+    params: dict
+        parameters pass into database query, e.g. {"City":"Ann Arbor"}
+
+    Returns
+    -------
+    string
+        the city name, or None if params select anything else
+    '''
+    if params is None or [k.lower() for k in params] != ["city"]:
+        return None
+    return list(params.values())[0]
+
+
+def get_aver_db(props_str, params=None, conn=None):
+    ''' give the average of a property of cafes
+
+    Parameters
+    ----------
+    props_str: string
+        property string to calculate info, e.g. "rating"
+    params: dict
+        parameters pass into database query, e.g. {"city":"Ann Arbor"}
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
+
+    Returns
+    -------
+    float
+        the average
+    '''
+    city = city_params(params)
+    if city is not None and props_str.lower() in [c.lower() for c in DATASET_COLUMNS]:
+        result = get_city_dataset(city, conn=conn)[props_str]
+    else:
+        result = [e[0] for e in get_busi_db_info([props_str], params=params, conn=conn)]
+    return sum(result) / len(result)
+
+
+def get_aver_info_db(props_str, params=None, conn=None):
+    ''' give the average info of cafes of a city
+
+    Parameters
+    ----------
+    props_str: string
+        property string to calculate info, e.g. "rating"
+    params: dict
+        parameters pass into database query, e.g. {"city":"Ann Arbor"}
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
+
+    Returns
+    -------
+    string
+        average rating
+    '''
+    aver_info = get_aver_db(props_str, params=params, conn=conn)
+    res = "*" * len("Average %s of the city is %s" % (props_str, aver_info))
+    res += "\n"
+    res += "Average %s of %s city is %s" % (props_str, params["City"], aver_info)
+    res += "\n"
+    res += "*" * len("Average %s of the city is %s" % (props_str, aver_info))
+    return res
+
+
+def get_best_busi(params=None, conn=None):
+    ''' give the best cafe of a city based on highest rating,
+    then highest review numbers
+
+    Parameters
+    ----------
+    params: dict
+        parameters pass into database query, e.g. {"city":"Ann Arbor"}
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
+
+    Returns
+    -------
+    tuple
+        (rating, review_number, Name, City, Address) of best cafe.
+    '''
+    city = city_params(params)
+    if city is not None:
+        dataset = get_city_dataset(city, conn=conn)
+        result = zip(dataset["rating"], dataset["review_number"],
+                     dataset["name"], dataset["city"], dataset["address"])
+    else:
+        result = get_busi_db_info(["rating", "review_number",
+                                   "Name", "City", "Address"], params=params, conn=conn)
+    return max(result, key=lambda x: (x[0], x[1]))
+
+
+def get_best_busi_based_on_rating_review(params=None, conn=None):
+    ''' give the best cafe of a city based on highest rating,
+    then highest review numbers
+
+    Parameters
+    ----------
+    params: dict
+        parameters pass into database query, e.g. {"city":"Ann Arbor"}
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
+
+    Returns
+    -------
+    string
+        name and address of best cafe.
+    '''
+    best = get_best_busi(params=params, conn=conn)
+    result_str = "*" * 40 + "\n"
+    result_str += "The best coffee we recommend: \n" \
+                  "{}: {}, \n" \
+                  "rating: {}, review number: {} " \
+                  "".format(best[2], best[3] + ", " + best[4], best[0], best[1])
+    result_str += "\n" + "*" * 40
+    return result_str
+
+
+def build_state_index(states_and_cities):
+    ''' build a search index of state names
+
+    Parameters
+    ----------
+    states_and_cities: dict
+        The dict of states, the key is state's name, the values are selected cities
+
+    Returns
+    -------
+    SearchIndex
+        the value of a state is its key in states_and_cities
+    '''
+    return SearchIndex(list(states_and_cities.keys()))
+
+
+def build_city_index(states_and_cities):
+    ''' build a search index of city names for each state
+
+    Parameters
+    ----------
+    states_and_cities: dict
+        The dict of states, the key is state's name, the values are selected cities
+
+    Returns
+    -------
+    dict
+        the key is state's name, the value is a SearchIndex of its cities,
+        the value of a city is its position in the state's list
+    '''
+    city_index = {}
+    for state in states_and_cities:
+        index = SearchIndex()
+        for i, city in enumerate(states_and_cities[state]):
+            index.add(city, i)
+        city_index[state] = index
+    return city_index
+
+
+def get_cafe_index():
+    ''' give a search index of the names of all cafes in database,
+    built again only after Businesses rows were written, i.e. after
+    invalidate_city_dataset or check_businesses_version, or when DB_NAME
+    is another database
+
+    Returns
+    -------
+    SearchIndex
+        the value of a cafe is its (Name, City, Address, Rating) tuple
+    '''
+    check_businesses_version()
+    with DATASET_LOCK:
+        version = (db_file_path(), DATASET_GENERATION["count"])
+    if CAFE_INDEX["index"] is None or CAFE_INDEX["version"] != version:
+        index = SearchIndex()
+        if os.path.exists(DB_NAME):
+            for bu in get_busi_db_info(["Name", "City", "Address", "rating"]):
+                index.add(bu[0], bu)
+        CAFE_INDEX["index"] = index
+        CAFE_INDEX["version"] = version
+    return CAFE_INDEX["index"]
+
+
+def search_cafes(query, limit=10):
+    ''' search cafes by name, by exact name, prefix or substring,
+    or allowing typos if none of them matches
+
+    Parameters
+    ----------
+    query: string
+        (part of) a cafe name
+    limit: int
+        the most cafes to give
+
+    Returns
+    -------
+    list
+        (Name, City, Address, Rating) tuples of the cafes
+    '''
+    return get_cafe_index().search(query, limit)
+
+
+def input_state_name(states_and_cities, state_index=None):
+    ''' interactive: let user input a choice from "exit" or valid name of a state.
+    When get a invalid input, close state names are suggested and input
+    operation will be required until get a valid one.
+    When get "exit", the program exits.
+
+    Parameters
+    ----------
+    states_and_cities: dict
+        The dict of states, the key is state's name, the values are selected cities
+    state_index: SearchIndex
+        index from build_state_index, built if None
+
+    Returns
+    -------
+    string
+        a state's name
+    '''
+    if state_index is None:
+        state_index = build_state_index(states_and_cities)
+    while True:
+        state_name = input('''Enter a state name (e.g. Michigan, michigan) or "exit": ''')
+        if state_name.lower() == "exit":
+            exit()
+        found = state_index.exact(state_name)
+        if len(found) > 0:
+            state_name = found[0]
+            break
+        print("[Error] Enter proper state name")
+        suggestions = state_index.search(state_name, 3)
+        if len(suggestions) > 0:
+            print("Did you mean: %s?" % ", ".join(suggestions))
+        print()
+    return state_name
+
+
+def input_city_number(cities, city_index=None):
+    ''' interactive: let user input a choice from "exit", valid number of cities
+    number or a city name. A name can be part of a city name or have typos,
+    as long as it matches one city.
+    When get a invalid input, input operation will be required until get a valid one.
+
+    Parameters
+    -------
     cities: list
+    city_index: SearchIndex
+        index of cities from build_city_index, built if None
 
     Returns
     -------
@@ -531,17 +1668,25 @@ def input_city_number(cities):
     '''
     cities_numbers = list(range(1, len(cities) + 1))
     cities_numbers = [str(i) for i in cities_numbers]
+    if city_index is None:
+        city_index = build_city_index({"": cities})[""]
     while True:
         num = input(
-            '''To see different Cafes, please enter a city number from [%s, %s] or "exit": ''' % (1, len(cities)))
+            '''To see different Cafes, please enter a city number from [%s, %s], a city name or "exit": ''' % (1, len(cities)))
         if num.lower() == "exit":
             exit()
-        elif num not in cities_numbers:
-            print("[Error] Enter proper city number from [%s, %s]" % (1, len(cities)))
-            print()
-        else:
-            break
-    return int(num) - 1
+        elif num in cities_numbers:
+            return int(num) - 1
+        found = city_index.exact(num)
+        if len(found) == 0:
+            found = city_index.search(num, 5)
+        if len(found) == 1:
+            return found[0]
+        print("[Error] Enter proper city number from [%s, %s]" % (1, len(cities)))
+        if len(found) > 1:
+            print("Matching cities: %s" % ", ".join(
+                "%s. %s" % (i + 1, cities[i]) for i in found))
+        print()
 
 
 def input_user_choice():
@@ -561,9 +1706,11 @@ def input_user_choice():
     print("3. Cafes businesses map in this city.")
     print("4. Kernel density distribution of rating of cafes in this city.")
     print("5. Scatter plot of rating and review number of cafes in this city.")
-    print("6. Plot price pie chart based on rating.")
+    print("6. Plot price pie charts based on rating.")
     print("7. Choose a new city.")
-    right_choice = list(range(1, 8))
+    print("8. Search cafes by name.")
+    print("9. Heatmap of price levels and ratings of cafes in this city.")
+    right_choice = list(range(1, 10))
     right_choice = [str(i) for i in right_choice]
     while True:
         num = input("Enter a choice to process/visualize data or 'exit':")
@@ -607,28 +1754,27 @@ def display_businesses(yelp_buss_objs):
         print(str(i + 1) + ". " + yelp_buss_objs[i].info())
 
 
-def map_businesses(user_city):
+@metrics.timed("figure_build_seconds", figure="map_businesses")
+def map_businesses(user_city, conn=None):
     ''' show cafes of a city in map
 
     Parameters
     ----------
     user_city: str
         a city name
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
 
     Return
     ----------
     fig: plotly figure object
         a plotly figure
     '''
-    text_list = []
-    lat_list = []
-    lon_list = []
-    ra_list = []
-    for bu in get_busi_db_info(["Name", "City", "Address", "Latitude", "Longitude", "rating"], {"City": user_city}):
-        text_list.append("{} ({}): {}, rating: {}".format(bu[0], bu[1], bu[2], bu[5]))
-        lat_list.append(bu[3])
-        lon_list.append(bu[4])
-        ra_list.append(bu[5])
+    dataset = get_city_dataset(user_city, conn=conn)
+    text_list = dataset.texts
+    lat_list = dataset["latitude"]
+    lon_list = dataset["longitude"]
+    ra_list = dataset["rating"]
 
     ave_lat = sum(lat_list) / len(lat_list)
     ave_lon = sum(lon_list) / len(lon_list)
@@ -665,6 +1811,24 @@ def map_businesses(user_city):
     return fig
 
 
+def display_cafes_found(cafes):
+    ''' display the cafes found by search_cafes
+
+    Parameters
+    ----------
+    cafes: list
+        (Name, City, Address, Rating) tuples
+    '''
+    if len(cafes) == 0:
+        display_print("Oops, no cafe matches.")
+        return
+    print("-" * len("Cafes found."))
+    print("Cafes found.")
+    print("-" * len("Cafes found."))
+    for i in range(len(cafes)):
+        print(str(i + 1) + ". " + "{} ({}): {}, rating: {}".format(*cafes[i]))
+
+
 def display_print(text):
     ''' stress the text with symbol *
 
@@ -678,24 +1842,23 @@ def display_print(text):
     print("*" * len(text))
 
 
-def kde_rating(user_city):
+@metrics.timed("figure_build_seconds", figure="kde_rating")
+def kde_rating(user_city, conn=None):
     ''' show kde distribution of ratings
 
     Parameters
     ----------
     user_city: str
         a city name
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
 
     Return
     ----------
     fig: plotly figure object
         a plotly figure
     '''
-    text_list = []
-    ra_list = []
-    for bu in get_busi_db_info(["Name", "City", "Address", "rating"], {"City": user_city}):
-        text_list.append("{} ({}): {}, rating: {}".format(bu[0], bu[1], bu[2], bu[3]))
-        ra_list.append(bu[3])
+    ra_list = get_city_dataset(user_city, conn=conn)["rating"]
     fig = ff.create_distplot([ra_list], ['rating'], bin_size=.2,
                              show_hist=False, show_rug=False)
     fig.update_xaxes(title_text="Ratings", ticks="inside")
@@ -705,26 +1868,26 @@ def kde_rating(user_city):
                       title={'text': "Rating distribution"})
     return fig
 
-def review_rating_scatter(user_city):
+@metrics.timed("figure_build_seconds", figure="review_rating_scatter")
+def review_rating_scatter(user_city, conn=None):
     ''' show scatter plot, rating versus to review numbers
 
     Parameters
     ----------
     user_city: str
         a city name
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
 
     Return
     ----------
     fig: plotly figure object
         a plotly figure
     '''
-    text_list = []
-    ra_list = []
-    re_list = []
-    for bu in get_busi_db_info(["Name", "City", "Address", "rating", "review_number"], {"City": user_city}):
-        text_list.append("{} ({}): {}, rating: {}".format(bu[0], bu[1], bu[2], bu[3]))
-        ra_list.append(bu[3])
-        re_list.append(bu[4])
+    dataset = get_city_dataset(user_city, conn=conn)
+    text_list = dataset.texts
+    ra_list = dataset["rating"]
+    re_list = dataset["review_number"]
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=ra_list,y=re_list,
                     mode="markers",
@@ -744,47 +1907,94 @@ def review_rating_scatter(user_city):
                       title={'text': "Review number and rating scatter plot"})
     return fig
 
-def review_rating_scatter(user_city):
-    ''' show scatter plot, rating versus to review numbers
+def price_label(price):
+    ''' give the label of a price string, e.g. "level 2" for "$$" '''
+    if len(price) == 0:
+        return "no price information"
+    return "level " + str(len(price))
+
+
+def build_price_rating_matrix(rows):
+    ''' make the matrix of get_price_rating_matrix from counted rows
+
+    Parameters
+    ----------
+    rows: list
+        (rating, price, count) tuples, in increasing order of rating
+
+    Return
+    ----------
+    dict
+        see get_price_rating_matrix
+    '''
+    matrix = {}
+    for rating, price, count in rows:
+        label = price_label(price)
+        prices = matrix.setdefault(rating, {})
+        prices[label] = prices.get(label, 0) + count
+    return matrix
+
+
+def get_price_rating_matrix(user_city=None, state=None, min_rating=None,
+                            max_rating=None, conn=None):
+    ''' count cafes of each price level for every rating level, from the
+    dataset of a city, or in one GROUP BY query over all cities of a state
 
     Parameters
     ----------
     user_city: str
-        a city name
+        a city name, or None
+    state: str
+        a state name, used if user_city is None
+    min_rating: float
+        lowest rating to count, None for no lower bound
+    max_rating: float
+        highest rating to count, None for no upper bound
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
 
     Return
     ----------
-    fig: plotly figure object
-        a plotly figure
+    dict
+        key is a rating in increasing order, value is a dict whose key is
+        a price label, e.g. "level 2", and value is the number of cafes
     '''
-    text_list = []
-    ra_list = []
-    re_list = []
-    for bu in get_busi_db_info(["Name", "City", "Address", "rating", "review_number"], {"City": user_city}):
-        text_list.append("{} ({}): {}, rating: {}".format(bu[0], bu[1], bu[2], bu[3]))
-        ra_list.append(bu[3])
-        re_list.append(bu[4])
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(x=ra_list,y=re_list,
-                    mode="markers",
-                    marker=dict(
-                        size=15,
-                        color = ra_list,
-                        colorbar=dict(title="ratings"),
-                        colorscale="rdylbu"),
-                    text=text_list,
-                    textposition="top center",
-                    opacity=0.8
-                    ))
-    fig.update_xaxes(title_text="Ratings", ticks="inside")
-    fig.update_yaxes(title_text="Review numbers", ticks="inside")
-    fig.update_layout(font=dict(size=20, family='Calibri', color='black'),
-                      # template="ggplot2",
-                      title={'text': "Review number and rating scatter plot"})
-    return fig
+    if user_city is not None:
+        dataset = get_city_dataset(user_city, conn=conn)
+        counts = collections.Counter(
+            (rating, price) for rating, price in zip(dataset["rating"], dataset["price"])
+            if (min_rating is None or rating >= min_rating)
+            and (max_rating is None or rating <= max_rating))
+        return build_price_rating_matrix(
+            [key + (counts[key],) for key in sorted(counts)])
+    command = "SELECT b.Rating, b.Price, COUNT(*) FROM Businesses as b"
+    conditions = []
+    values = []
+    if state is not None:
+        conditions.append("b.CityId IN (SELECT Id FROM Cities WHERE State = ?)")
+        values.append(state.lower())
+    if min_rating is not None:
+        conditions.append("b.Rating >= ?")
+        values.append(min_rating)
+    if max_rating is not None:
+        conditions.append("b.Rating <= ?")
+        values.append(max_rating)
+    if len(conditions) > 0:
+        command += " WHERE " + " AND ".join(conditions)
+    command += " GROUP BY b.Rating, b.Price ORDER BY b.Rating;"
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(DB_NAME)
+    with metrics.Timer("sql_seconds", op="get_price_rating_matrix"):
+        result = conn.execute(command, values).fetchall()
+    if own_conn:
+        conn.close()
+    metrics.inc("db_rows_scanned_total", table="Businesses", value=sum(r[2] for r in result))
+    return build_price_rating_matrix(result)
 
-def pie_price_highest_rating(user_city, rating = 5.0):
-    ''' give the price pie chart with same rating
+
+def get_price_distribution(user_city, rating=5.0, conn=None):
+    ''' count cafes of each price level among cafes with same rating
 
     Parameters
     ----------
@@ -792,69 +2002,143 @@ def pie_price_highest_rating(user_city, rating = 5.0):
         a city name
     rating: float
         a rating score of businesses
+    conn: sqlite3.Connection
+        connection to query with, see get_busi_db_info
 
+    Return
+    ----------
+    dict
+        key is a price label, e.g. "level 2" or "no price information",
+        value is the number of cafes
     '''
-    text_list = []
-    ra_list = []
-    price_list = []
-    for bu in get_busi_db_info(["Name", "City", "Address", "rating", "price"],
-                               {"City": user_city, "rating": rating}):
-        text_list.append("{} ({}): {}, rating: {}".format(bu[0], bu[1], bu[2], bu[3]))
-        ra_list.append(bu[3])
-        price_list.append(bu[4])
-    fig = go.Figure()
-    if len(price_list) == 0:
-        display_print("Oops, no cafe has %s rating." % rating)
-        return None
-    result = {}
-    for key in price_list:
-        result[key] = result.get(key, 0) + 1
-    labels = list(result.keys())
-    num_labels = []
-    for la in labels:
-        if len(la) == 0:
-            num_labels.append("no price information")
-        else:
-            num_labels.append("level "+str(len(la)))
-    values = list(result.values())
-    fig.add_trace(go.Pie(labels=num_labels, values=values))
-    fig.show()
+    matrix = get_price_rating_matrix(user_city, min_rating=rating, max_rating=rating, conn=conn)
+    return matrix.get(rating, {})
+
 
-def input_rating():
-    ''' get the input of user between 0 and 5 with error check.
+@metrics.timed("figure_build_seconds", figure="pies_price_by_rating")
+def pies_price_by_rating(matrix, title="Price levels by rating"):
+    ''' show one price pie chart for every rating level of a matrix
+
+    Parameters
+    ----------
+    matrix: dict
+        result of get_price_rating_matrix, not empty
+    title: str
+        title of the figure
 
     Return
     ----------
-    float
-        The user input
+    fig: plotly figure object
+        a plotly figure
+    '''
+    ratings = list(matrix.keys())
+    cols = min(len(ratings), 5)
+    rows = (len(ratings) + cols - 1) // cols
+    fig = make_subplots(rows=rows, cols=cols,
+                        specs=[[{"type": "domain"}] * cols] * rows,
+                        subplot_titles=["rating %s" % r for r in ratings])
+    for i in range(len(ratings)):
+        labels = [la for la in PRICE_LABELS if la in matrix[ratings[i]]]
+        fig.add_trace(go.Pie(labels=labels,
+                             values=[matrix[ratings[i]][la] for la in labels],
+                             marker=dict(colors=[PRICE_COLORS[PRICE_LABELS.index(la)]
+                                                 for la in labels]),
+                             sort=False, name="rating %s" % ratings[i]),
+                      row=i // cols + 1, col=i % cols + 1)
+    fig.update_layout(title={'text': title})
+    return fig
+
+
+@metrics.timed("figure_build_seconds", figure="heatmap_price_by_rating")
+def heatmap_price_by_rating(matrix, title="Price levels by rating"):
+    ''' show a heatmap of the number of cafes of each price level
+    and rating level of a matrix
+
+    Parameters
+    ----------
+    matrix: dict
+        result of get_price_rating_matrix, not empty
+    title: str
+        title of the figure
+
+    Return
+    ----------
+    fig: plotly figure object
+        a plotly figure
+    '''
+    ratings = list(matrix.keys())
+    fig = go.Figure(go.Heatmap(x=PRICE_LABELS, y=[str(r) for r in ratings],
+                               z=[[matrix[r].get(la, 0) for la in PRICE_LABELS] for r in ratings],
+                               colorscale="ylorrd", colorbar=dict(title="cafes")))
+    fig.update_xaxes(title_text="Price", ticks="inside")
+    fig.update_yaxes(title_text="Ratings", ticks="inside", type="category")
+    fig.update_layout(font=dict(size=20, family='Calibri', color='black'),
+                      title={'text': title})
+    return fig
+
+
+def input_rating_range():
+    ''' get a rating, a rating range or all ratings from the user,
+    between 0 and 5 with error check.
+
+    Return
+    ----------
+    tuple
+        (lowest rating, highest rating), (None, None) for all ratings
     '''
     while True:
+        a = input("Please input a rating [0.0,5.0] (e.g. 4.5), a range (e.g. 3.5-5) or 'all': ")
+        if a.lower() == "exit":
+            exit()
+        if a.strip().lower() in ("all", ""):
+            return None, None
         try:
-            a = input("Please input a rating you are interested in [0.0,5.0], e.g. 4.5: ")
-            if a.lower() == "exit":
-                exit()
-            a = float(a)
-            if a >= 0 and a <= 5:
-                return a
-                break
-            else:
-                print("Input is not in range! Try again")
-        except:
+            bounds = [float(e) for e in a.split("-")]
+        except ValueError:
             print("Error happens! Try again!")
+            continue
+        if len(bounds) == 1:
+            bounds = bounds * 2
+        if len(bounds) != 2 or not 0 <= bounds[0] <= bounds[1] <= 5:
+            print("Input is not in range! Try again")
+        else:
+            return bounds[0], bounds[1]
+
+
+def report_metrics():
+    ''' print the metrics summary. If the environment variable
+    FINAL_PROJECT_METRICS is a file path, also dump the metrics there,
+    as JSON for a .json path, else as Prometheus text.
+    '''
+    print(metrics.summary())
+    metrics_file = os.environ.get("FINAL_PROJECT_METRICS")
+    if metrics_file:
+        metrics.dump(metrics_file)
+
 
 if __name__ == "__main__":
+    atexit.register(report_metrics)
     CACHE_DICT = load_cache()
     states_and_cities = build_state_cities_dict()
     save_city_table(states_and_cities)
+    state_index = build_state_index(states_and_cities)
+    city_index = build_city_index(states_and_cities)
 
     while True:
-        state_name = input_state_name(states_and_cities)
+        state_name = input_state_name(states_and_cities, state_index)
         cities = states_and_cities[state_name.lower()]
         display_cities(cities)
-        city_num = input_city_number(cities)
+        city_num = input_city_number(cities, city_index[state_name.lower()])
         user_city = cities[city_num]
 
-        yelp_business_dict = get_yelp_bussiness_search(user_city)
+        try:
+            yelp_business_dict = load_city_businesses(user_city, state=state_name.lower())
+        except QuotaExceededError as e:
+            display_print("Oops, %s. Please choose a city queried before." % e)
+            continue
+        except YelpApiError as e:
+            display_print("Oops, %s. Please try again later." % e)
+            continue
         yelp_buss_objs = build_buss_objs_from_dict(user_city, yelp_business_dict)
         display_businesses(yelp_buss_objs)
 
@@ -878,6 +2162,15 @@ if __name__ == "__main__":
                 display_print("Scatter plot of review number versus rating in %s city" % user_city)
                 fig = review_rating_scatter(user_city)
                 fig.show()
-            if user_choice == 6:
-                rat = input_rating()
-                pie_price_highest_rating(user_city, rating=rat)
\ No newline at end of file
+            if user_choice == 6 or user_choice == 9:
+                min_rat, max_rat = input_rating_range()
+                matrix = get_price_rating_matrix(user_city, min_rating=min_rat, max_rating=max_rat)
+                if len(matrix) == 0:
+                    display_print("Oops, no cafe has rating in this range.")
+                elif user_choice == 6:
+                    pies_price_by_rating(matrix, "Price levels by rating in %s city" % user_city).show()
+                else:
+                    heatmap_price_by_rating(matrix, "Price levels by rating in %s city" % user_city).show()
+            if user_choice == 8:
+                query = input("Enter a cafe name to search: ")
+                display_cafes_found(search_cafes(query))
\ No newline at end of file
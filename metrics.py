@@ -0,0 +1,275 @@
+''' Counters and latency histograms of the cafes pipeline.
+
+Metrics are kept in the module level METRICS dict, keyed by metric name and
+labels, e.g. ("http_requests_total", (("status", "200"),)). They can be
+printed as a summary, or dumped as JSON or Prometheus text.
+'''
+
+import functools
+import json
+import threading
+import time
+
+PREFIX = "final_project_"
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float("inf")]
+METRICS = {"counters": {}, "histograms": {}}
+LOCK = threading.Lock()
+
+
+def make_key(name, labels):
+    ''' make the METRICS key of a metric name and its labels
+
+    Parameters
+    ----------
+    name: string
+        metric name
+    labels: dict
+        label:value pairs, may be empty
+
+    Returns
+    -------
+    tuple
+        (name, sorted tuple of (label, value) pairs)
+    '''
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def inc(name, value=1, **labels):
+    ''' add value to a counter
+
+    Parameters
+    ----------
+    name: string
+        counter name, e.g. "cache_hits_total"
+    value: int
+        amount to add
+    labels: keyword arguments
+        labels of the counter, e.g. status=200
+    '''
+    key = make_key(name, labels)
+    with LOCK:
+        METRICS["counters"][key] = METRICS["counters"].get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    ''' record one value, e.g. a latency in seconds, into a histogram
+
+    Parameters
+    ----------
+    name: string
+        histogram name, e.g. "sql_seconds"
+    value: float
+        the value to record
+    labels: keyword arguments
+        labels of the histogram, e.g. op="get_busi_db_info"
+    '''
+    key = make_key(name, labels)
+    with LOCK:
+        hist = METRICS["histograms"].get(key)
+        if hist is None:
+            hist = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(BUCKETS)}
+            METRICS["histograms"][key] = hist
+        hist["count"] += 1
+        hist["sum"] += value
+        hist["max"] = max(hist["max"], value)
+        for i in range(len(BUCKETS)):
+            if value <= BUCKETS[i]:
+                hist["buckets"][i] += 1
+                break
+
+
+class Timer():
+    '''context manager recording the seconds spent in its block
+    into a histogram
+
+    Instance Attributes
+    -------------------
+    name: string
+        histogram name
+
+    labels: dict
+        labels of the histogram
+    '''
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def timed(name, **labels):
+    ''' decorator recording the seconds spent in each call of the function
+
+    Parameters
+    ----------
+    name: string
+        histogram name
+    labels: keyword arguments
+        labels of the histogram
+
+    Returns
+    -------
+    function
+        the decorator
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset():
+    ''' forget every recorded metric '''
+    with LOCK:
+        METRICS["counters"].clear()
+        METRICS["histograms"].clear()
+
+
+def snapshot():
+    ''' copy the recorded metrics under LOCK, so that they can be read
+    while other threads record new ones
+
+    Returns
+    -------
+    dict
+        "counters" and "histograms" like METRICS
+    '''
+    with LOCK:
+        return {"counters": dict(METRICS["counters"]),
+                "histograms": {k: dict(h, buckets=list(h["buckets"]))
+                               for k, h in METRICS["histograms"].items()}}
+
+
+def counter_total(name, metrics=None):
+    ''' sum a counter over all its labels
+
+    Parameters
+    ----------
+    name: string
+        counter name
+    metrics: dict
+        a snapshot to read, None to take one
+
+    Returns
+    -------
+    int
+        the sum
+    '''
+    if metrics is None:
+        with LOCK:
+            return sum(v for k, v in METRICS["counters"].items() if k[0] == name)
+    return sum(v for k, v in metrics["counters"].items() if k[0] == name)
+
+
+def format_labels(labels):
+    ''' format labels as {a="1",b="2"}, or "" if there is none '''
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, v) for k, v in labels) + "}"
+
+
+def summary():
+    ''' make a human readable summary of the recorded metrics
+
+    Returns
+    -------
+    string
+        the summary, with the cache hit ratio, every counter and
+        count/total/mean/max of every histogram
+    '''
+    metrics = snapshot()
+    lines = ["-" * len("Metrics summary"), "Metrics summary", "-" * len("Metrics summary")]
+    hits = counter_total("cache_hits_total", metrics)
+    misses = counter_total("cache_misses_total", metrics)
+    if hits + misses > 0:
+        lines.append("cache hit ratio: %.1f%% (%s hits, %s misses)" % (
+            100.0 * hits / (hits + misses), hits, misses))
+    for key in sorted(metrics["counters"]):
+        lines.append("%s%s: %s" % (key[0], format_labels(key[1]), metrics["counters"][key]))
+    for key in sorted(metrics["histograms"]):
+        hist = metrics["histograms"][key]
+        lines.append("%s%s: count %s, total %.4fs, mean %.4fs, max %.4fs" % (
+            key[0], format_labels(key[1]), hist["count"], hist["sum"],
+            hist["sum"] / hist["count"], hist["max"]))
+    return "\n".join(lines)
+
+
+def to_json():
+    ''' dump the recorded metrics as a JSON string
+
+    Returns
+    -------
+    string
+        JSON with a list of counters and a list of histograms
+    '''
+    metrics = snapshot()
+    counters = [{"name": k[0], "labels": dict(k[1]), "value": v}
+                for k, v in sorted(metrics["counters"].items())]
+    histograms = []
+    for key, hist in sorted(metrics["histograms"].items()):
+        buckets = {("+Inf" if b == float("inf") else str(b)): n
+                   for b, n in zip(BUCKETS, hist["buckets"])}
+        histograms.append({"name": key[0], "labels": dict(key[1]),
+                           "count": hist["count"], "sum": hist["sum"],
+                           "max": hist["max"], "buckets": buckets})
+    return json.dumps({"counters": counters, "histograms": histograms}, indent=2)
+
+
+def to_prometheus():
+    ''' dump the recorded metrics in Prometheus text exposition format
+
+    Returns
+    -------
+    string
+        the Prometheus text
+    '''
+    metrics = snapshot()
+    lines = []
+    typed = set()
+    for key, value in sorted(metrics["counters"].items()):
+        name = PREFIX + key[0]
+        if name not in typed:
+            lines.append("# TYPE %s counter" % name)
+            typed.add(name)
+        lines.append("%s%s %s" % (name, format_labels(key[1]), value))
+    for key, hist in sorted(metrics["histograms"].items()):
+        name = PREFIX + key[0]
+        if name not in typed:
+            lines.append("# TYPE %s histogram" % name)
+            typed.add(name)
+        cumulative = 0
+        for bound, n in zip(BUCKETS, hist["buckets"]):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else str(bound)
+            lines.append("%s_bucket%s %s" % (name, format_labels(key[1] + (("le", le),)), cumulative))
+        lines.append("%s_sum%s %s" % (name, format_labels(key[1]), hist["sum"]))
+        lines.append("%s_count%s %s" % (name, format_labels(key[1]), hist["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    ''' save the recorded metrics to a file, as JSON if path ends
+    with .json, else as Prometheus text
+
+    Parameters
+    ----------
+    path: string
+        file path
+    '''
+    if path.endswith(".json"):
+        contents = to_json()
+    else:
+        contents = to_prometheus()
+    f = open(path, 'w')
+    f.write(contents)
+    f.close()
@@ -0,0 +1,452 @@
+''' HTTP service answering queries over the businesses database.
+
+Every route answers JSON to GET requests:
+
+    /average?city=Ann Arbor&prop=rating     average of a property
+    /best?city=Ann Arbor                    best cafe by rating, then reviews
+    /price?city=Ann Arbor&rating=4.5        cafes of each price level
+    /price_matrix?state=michigan&min_rating=4
+                                            cafes of each price level for
+                                            every rating (city or state,
+                                            optional rating range)
+    /figure/map?city=Ann Arbor              plotly figure JSON, likewise
+    /figure/kde?city=...                    /figure/kde and /figure/scatter.
+                                            The map has no mapbox token,
+                                            clients set their own.
+    /metrics                                Prometheus text of metrics.py
+
+The service runs on asyncio. Queries run in a thread pool, each thread
+borrowing a read-only sqlite connection from a pool. Answers are cached
+in memory until the Businesses rows change, and carry an ETag so clients
+can revalidate with If-None-Match and get 304 Not Modified.
+
+Usage:
+
+    $ python query_service.py --port 8507
+'''
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import math
+import os
+import queue
+import sqlite3
+import urllib.parse
+import urllib.request
+
+import final_project as fp
+import metrics
+
+DEFAULT_PORT = 8507
+POOL_SIZE = 8
+CACHE_SIZE = 1024
+REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class ConnectionPool():
+    '''a fixed number of read-only sqlite connections shared by threads
+
+    Instance Attributes
+    -------------------
+    db_name: string
+        path of the database
+
+    size: int
+        number of connections
+    '''
+    def __init__(self, db_name, size=POOL_SIZE):
+        self.db_name = db_name
+        self.size = size
+        self.conns = queue.Queue()
+        uri = "file:%s?mode=ro" % urllib.request.pathname2url(os.path.abspath(db_name))
+        for i in range(size):
+            self.conns.put(sqlite3.connect(uri, uri=True, check_same_thread=False))
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''borrow a connection, waiting for one if all are in use'''
+        conn = self.conns.get()
+        try:
+            yield conn
+        finally:
+            self.conns.put(conn)
+
+    def close(self):
+        '''close every connection'''
+        for i in range(self.size):
+            self.conns.get().close()
+
+
+def get_city(params):
+    ''' get the required city parameter
+
+    Parameters
+    ----------
+    params: dict
+        query string parameters
+
+    Returns
+    -------
+    string
+        the city name
+    '''
+    if not params.get("city"):
+        raise ValueError("city is required")
+    return params["city"]
+
+
+def get_rating(params, name, default=None):
+    ''' get a rating parameter
+
+    Parameters
+    ----------
+    params: dict
+        query string parameters
+    name: string
+        parameter name, e.g. "min_rating"
+    default: float
+        the rating if the parameter is missing or empty
+
+    Returns
+    -------
+    float
+        the rating
+    '''
+    if not params.get(name):
+        return default
+    try:
+        rating = float(params[name])
+    except ValueError:
+        raise ValueError("%s must be a number" % name)
+    if not math.isfinite(rating):
+        raise ValueError("%s must be a finite number" % name)
+    return rating
+
+
+def route_average(params, conn):
+    '''average of prop ("rating" or "review_number") of cafes of a city'''
+    city = get_city(params)
+    prop = params.get("prop", "rating")
+    if prop not in ("rating", "review_number"):
+        raise ValueError("prop must be rating or review_number")
+    try:
+        average = fp.get_aver_db(prop, {"City": city}, conn=conn)
+    except ZeroDivisionError:
+        raise LookupError("no cafe in %s" % city)
+    return {"city": city, "prop": prop, "average": average}
+
+
+def route_best(params, conn):
+    '''best cafe of a city based on highest rating, then highest review numbers'''
+    city = get_city(params)
+    try:
+        best = fp.get_best_busi({"City": city}, conn=conn)
+    except ValueError:
+        raise LookupError("no cafe in %s" % city)
+    return {"city": city, "name": best[2], "address": best[3] + ", " + best[4],
+            "rating": best[0], "review_number": best[1]}
+
+
+def route_price(params, conn):
+    '''number of cafes of each price level among cafes with a rating'''
+    city = get_city(params)
+    rating = get_rating(params, "rating", 5.0)
+    if len(fp.get_city_dataset(city, conn=conn)) == 0:
+        raise LookupError("no cafe in %s" % city)
+    return {"city": city, "rating": rating,
+            "prices": fp.get_price_distribution(city, rating, conn=conn)}
+
+
+def route_price_matrix(params, conn):
+    '''number of cafes of each price level for every rating level'''
+    if not params.get("city") and not params.get("state"):
+        raise ValueError("city or state is required")
+    bounds = {}
+    for name in ("min_rating", "max_rating"):
+        bounds[name] = get_rating(params, name)
+    matrix = fp.get_price_rating_matrix(params.get("city"), params.get("state"),
+                                        bounds["min_rating"], bounds["max_rating"], conn=conn)
+    return {"city": params.get("city"), "state": params.get("state"),
+            "ratings": [{"rating": r, "prices": matrix[r]} for r in matrix]}
+
+
+def map_without_token(user_city, conn=None):
+    ''' build fp.map_businesses without the mapbox token of secrets.py,
+    which is not served to clients. Dashboards set their own token.
+    '''
+    fig = fp.map_businesses(user_city, conn=conn)
+    fig.layout.mapbox.accesstoken = None
+    return fig
+
+
+def make_figure_route(figure_builder, min_ratings=1):
+    ''' make a route answering the figure JSON of a figure builder
+
+    Parameters
+    ----------
+    figure_builder: function
+        e.g. fp.map_businesses, called with a city and a connection
+    min_ratings: int
+        fewest distinct ratings the cafes of the city must have,
+        e.g. 2 for a density of ratings
+
+    Returns
+    -------
+    function
+        the route
+    '''
+    def route_figure(params, conn):
+        city = get_city(params)
+        dataset = fp.get_city_dataset(city, conn=conn)
+        if len(dataset) == 0:
+            raise LookupError("no cafe in %s" % city)
+        if len(set(dataset["rating"])) < min_ratings:
+            raise LookupError("cafes of %s have fewer than %s different ratings" % (
+                city, min_ratings))
+        return figure_builder(city, conn=conn).to_json()
+    return route_figure
+
+
+ROUTES = {"/average": route_average,
+          "/best": route_best,
+          "/price": route_price,
+          "/price_matrix": route_price_matrix,
+          "/figure/map": make_figure_route(map_without_token),
+          "/figure/kde": make_figure_route(fp.kde_rating, min_ratings=2),
+          "/figure/scatter": make_figure_route(fp.review_rating_scatter)}
+
+
+def make_etag(body):
+    ''' make the ETag header value of a response body
+
+    Parameters
+    ----------
+    body: bytes
+        the response body
+
+    Returns
+    -------
+    string
+        quoted sha1 hex digest
+    '''
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+def etag_matches(etag, if_none_match):
+    ''' check an ETag against an If-None-Match header value
+
+    Parameters
+    ----------
+    etag: string
+        the ETag of the response
+    if_none_match: string
+        the header value, a list of ETags or "*", or None
+
+    Returns
+    -------
+    bool
+        True if the client already has this response
+    '''
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+
+class QueryService():
+    '''asyncio HTTP service of the routes in ROUTES
+
+    Instance Attributes
+    -------------------
+    db_name: string
+        path of the database
+
+    pool: ConnectionPool
+        read-only connections used by the routes
+
+    cache: collections.OrderedDict
+        least recently used answers, key is (path, params, database version),
+        value is (status, body, etag)
+    '''
+    def __init__(self, db_name=fp.DB_NAME, pool_size=POOL_SIZE, cache_size=CACHE_SIZE):
+        self.db_name = db_name
+        self.pool = ConnectionPool(db_name, pool_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size)
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.inflight = {}
+
+    def db_version(self):
+        '''a value that changes whenever the Businesses rows are written'''
+        with self.pool.connection() as conn:
+            return fp.get_businesses_version(conn)
+
+    def run_route(self, route, params):
+        ''' run a route with a pooled connection, in a worker thread
+
+        Returns
+        -------
+        tuple
+            (status, body bytes)
+        '''
+        with self.pool.connection() as conn:
+            try:
+                result = route(params, conn)
+            except LookupError as e:
+                return 404, json.dumps({"error": str(e)}).encode("utf-8")
+            except ValueError as e:
+                return 400, json.dumps({"error": str(e)}).encode("utf-8")
+        if not isinstance(result, str):
+            result = json.dumps(result)
+        return 200, result.encode("utf-8")
+
+    async def answer(self, path, params):
+        ''' answer a route from the cache, or run it once for all
+        concurrent identical requests and cache the answer
+
+        Returns
+        -------
+        tuple
+            (status, body bytes, etag)
+        '''
+        version = self.db_version()
+        key = (path, tuple(sorted(params.items())), version)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            metrics.inc("service_cache_hits_total")
+            return self.cache[key]
+        metrics.inc("service_cache_misses_total")
+        if key not in self.inflight:
+            loop = asyncio.get_running_loop()
+            self.inflight[key] = loop.run_in_executor(self.executor, self.run_route,
+                                                      ROUTES[path], params)
+        try:
+            status, body = await asyncio.shield(self.inflight[key])
+        finally:
+            self.inflight.pop(key, None)
+        answer = (status, body, make_etag(body))
+        self.cache[key] = answer
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return answer
+
+    async def respond(self, method, target, request_headers):
+        ''' make the response of one request
+
+        Returns
+        -------
+        tuple
+            (status, headers dict, body bytes)
+        '''
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if method not in ("GET", "HEAD"):
+            return 405, {"Allow": "GET, HEAD"}, b""
+        if url.path == "/metrics":
+            return 200, {"Content-Type": "text/plain; version=0.0.4"}, \
+                metrics.to_prometheus().encode("utf-8")
+        if url.path not in ROUTES:
+            return 404, {}, json.dumps({"error": "no route %s" % url.path}).encode("utf-8")
+        try:
+            status, body, etag = await self.answer(url.path, params)
+        except Exception as e:
+            return 500, {}, json.dumps({"error": repr(e)}).encode("utf-8")
+        response_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if status == 200 and etag_matches(etag, request_headers.get("if-none-match")):
+            return 304, response_headers, b""
+        return status, response_headers, body
+
+    async def handle(self, reader, writer):
+        '''serve the requests of one client connection, keeping it alive'''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+                request_headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    request_headers[name.strip().lower()] = value.strip()
+                length = int(request_headers.get("content-length", "0") or 0)
+                if length > 0:
+                    await reader.readexactly(length)
+                connection = request_headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" or (
+                    version == "HTTP/1.1" and connection != "close")
+
+                with metrics.Timer("service_request_seconds"):
+                    status, response_headers, body = await self.respond(
+                        method, target, request_headers)
+                metrics.inc("service_requests_total", status=status)
+
+                response_headers.setdefault("Content-Type", "application/json")
+                response_headers["Content-Length"] = str(len(body))
+                response_headers["Connection"] = "keep-alive" if keep_alive else "close"
+                head = "HTTP/1.1 %s %s\r\n" % (status, REASONS[status])
+                head += "".join("%s: %s\r\n" % (k, v) for k, v in response_headers.items())
+                writer.write(head.encode("latin-1") + b"\r\n")
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        '''serve until cancelled'''
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        print("Serving %s on http://%s:%s" % (self.db_name, host, port))
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        '''stop the worker threads and close the connections'''
+        self.executor.shutdown()
+        self.pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve queries over the businesses database.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--db", default=fp.DB_NAME, help="path of the database")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE,
+                        help="read-only connections and worker threads")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE,
+                        help="answers kept in memory")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        parser.error("no database at %s" % args.db)
+
+    service = QueryService(args.db, args.pool_size, args.cache_size)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+''' Fetch again the cities whose cafes were fetched longer ago than the
+freshness window, the most used cities first, and write only the changed
+businesses into database.
+
+Usage:
+
+    $ python refresh.py --max-age-days 7 --limit 20
+'''
+
+import argparse
+
+import final_project as fp
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Refresh stale cities in the database.")
+    parser.add_argument("--max-age-days", type=float,
+                        default=fp.FRESHNESS_SECONDS / (24 * 60 * 60),
+                        help="days a fetched city stays fresh")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="the most cities to refresh")
+    args = parser.parse_args(argv)
+
+    fp.CACHE_DICT = fp.load_cache()
+    refreshed = fp.refresh_stale_cities(limit=args.limit,
+                                        freshness=args.max_age_days * 24 * 60 * 60)
+    for city, counts in refreshed:
+        print("%s: %s inserted, %s updated, %s deleted" % (
+            city, counts["inserted"], counts["updated"], counts["deleted"]))
+    if len(refreshed) == 0:
+        print("Every city is fresh.")
+
+
+if __name__ == "__main__":
+    main()
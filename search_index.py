@@ -0,0 +1,362 @@
+''' In-memory search index of names, e.g. states, cities or cafes.
+
+Names are normalized (lower case, letters and digits only) and indexed
+three times: a sorted list for prefix lookup by bisection, a trigram
+index for substring lookup, and an index of their words. Typo-tolerant
+lookup finds, for every word of the query, the indexed words within a
+small edit distance, then the names having a close word for every query
+word. Close words are found with an index of the strings made by
+deleting a few letters of every word: two words within d edits both
+give one same string by deleting at most d letters of each.
+'''
+
+import bisect
+import re
+
+MAX_DISTANCE = 2
+
+
+def normalize(text):
+    ''' lower case text, keep only letters, digits and single spaces
+
+    Parameters
+    ----------
+    text: string
+        a name or a query
+
+    Returns
+    -------
+    string
+        the normalized text
+    '''
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", text.lower()).split())
+
+
+def trigrams(text, pad=True):
+    ''' give the set of 3 letter substrings of text
+
+    Parameters
+    ----------
+    text: string
+        normalized text
+    pad: bool
+        pad with spaces, so that the start and end of text make trigrams
+
+    Returns
+    -------
+    set
+        the trigrams
+    '''
+    if pad:
+        text = "  " + text + " "
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def edit_distance(a, b, limit):
+    ''' edit distance between a and b, counting an insertion, a deletion,
+    a substitution or a swap of two adjacent letters as one edit, and
+    giving up above limit
+
+    Parameters
+    ----------
+    a: string
+    b: string
+    limit: int
+        the largest distance of interest
+
+    Returns
+    -------
+    int
+        the distance, or limit + 1 if it is larger than limit
+    '''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        before = previous
+        previous = current
+    return previous[-1]
+
+
+def default_distance(length):
+    ''' give the edits allowed for a word of a length, one for every
+    four letters, at most MAX_DISTANCE '''
+    return min(max(1, length // 4), MAX_DISTANCE)
+
+
+def delete_depth(length):
+    ''' give the most letters to delete from an indexed word of a length,
+    the largest default_distance of a query word that can be close to it
+    '''
+    depth = default_distance(length)
+    query_length = length
+    while query_length - default_distance(query_length) <= length:
+        depth = max(depth, default_distance(query_length))
+        query_length += 1
+    return depth
+
+
+def deletes(word, depth):
+    ''' give the strings made by deleting at most depth letters of word,
+    word included '''
+    found = {word}
+    edge = {word}
+    for i in range(depth):
+        edge = set(w[:j] + w[j + 1:] for w in edge for j in range(len(w)))
+        found |= edge
+    return found
+
+
+class SearchIndex():
+    '''an index of names, each with a value returned by lookups
+
+    Instance Attributes
+    -------------------
+    names: list
+        the names as added
+
+    keys: list
+        the normalized names
+
+    values: list
+        the values of the names, e.g. a (city, state) tuple
+
+    grams: dict
+        key is a trigram, value is the set of ids of names having it
+
+    words: dict
+        key is a word, value is the set of ids of names having it
+
+    word_grams: dict
+        key is a trigram, value is the set of words having it
+
+    word_deletes: dict
+        key is a word with at most delete_depth letters deleted, value is
+        the word giving it, or the set of words if several do (most keys
+        have one word, and a set takes ten times its memory)
+    '''
+    def __init__(self, names=None):
+        self.names = []
+        self.keys = []
+        self.values = []
+        self.grams = {}
+        self.words = {}
+        self.word_grams = {}
+        self.word_deletes = {}
+        self.sorted_keys = None
+        if names is not None:
+            for name in names:
+                self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, value=None):
+        ''' add a name to the index
+
+        Parameters
+        ----------
+        name: string
+            the name
+        value: any
+            returned by lookups of the name, the name itself if None
+        '''
+        i = len(self.names)
+        key = normalize(name)
+        self.names.append(name)
+        self.keys.append(key)
+        self.values.append(name if value is None else value)
+        for gram in trigrams(key):
+            self.grams.setdefault(gram, set()).add(i)
+        for word in key.split():
+            if word not in self.words:
+                self.words[word] = set()
+                for gram in trigrams(word):
+                    self.word_grams.setdefault(gram, set()).add(word)
+                for deleted in deletes(word, delete_depth(len(word))):
+                    words = self.word_deletes.get(deleted)
+                    if words is None:
+                        self.word_deletes[deleted] = word
+                    elif isinstance(words, str):
+                        self.word_deletes[deleted] = {words, word}
+                    else:
+                        words.add(word)
+            self.words[word].add(i)
+        self.sorted_keys = None
+
+    def exact(self, query):
+        ''' give the values of names equal to query, ignoring case
+        and punctuation '''
+        key = normalize(query)
+        return [self.values[i] for i in self.prefix_ids(key) if self.keys[i] == key]
+
+    def prefix_ids(self, key, limit=None):
+        ''' give the ids of names starting with a normalized key,
+        in alphabetical order, at most limit of them if given '''
+        if self.sorted_keys is None:
+            self.sorted_keys = sorted((self.keys[i], i) for i in range(len(self.keys)))
+        ids = []
+        for j in range(bisect.bisect_left(self.sorted_keys, (key, -1)), len(self.sorted_keys)):
+            k, i = self.sorted_keys[j]
+            if not k.startswith(key) or len(ids) == limit:
+                break
+            ids.append(i)
+        return ids
+
+    def prefix(self, query, limit=10):
+        ''' give the values of names starting with query '''
+        return [self.values[i] for i in self.prefix_ids(normalize(query), limit)]
+
+    def substring_ids(self, key, limit=None):
+        ''' give the ids of names containing a normalized key,
+        at most limit of them if given '''
+        if len(key) < 3:
+            ids = []
+            for i in range(len(self.keys)):
+                if len(ids) == limit:
+                    break
+                if key in self.keys[i]:
+                    ids.append(i)
+            return ids
+        postings = [self.grams.get(gram, set()) for gram in trigrams(key, pad=False)]
+        postings.sort(key=len)
+        ids = postings[0]
+        for posting in postings[1:]:
+            if len(ids) < 50:
+                break
+            ids = ids & posting
+        return sorted(i for i in ids if key in self.keys[i])[:limit]
+
+    def substring(self, query, limit=10):
+        ''' give the values of names containing query '''
+        return [self.values[i] for i in self.substring_ids(normalize(query), limit)]
+
+    def close_words(self, word, max_distance=None):
+        ''' give the indexed words within max_distance edits of a word.
+        By default one edit is allowed for every four letters of the word
+        (default_distance).
+
+        Up to the default, an edit (insertion, deletion, substitution or
+        swap) is undone by deleting at most one letter of each word, so a
+        close word shares a string of word_deletes with the word. Only
+        those words are compared letter by letter.
+
+        Above the default, one edit changes at most 4 trigrams (3, or 4
+        for a swap), so a close word has one of the 4 * max_distance + 1
+        rarest trigrams of the word, and shares all but 4 * max_distance
+        of its trigrams. The words passing both checks are compared. A word
+        with at most 4 * max_distance trigrams is compared to every word.
+
+        Returns
+        -------
+        dict
+            key is a close word, value is its distance
+        '''
+        if max_distance is None:
+            max_distance = default_distance(len(word))
+        candidates = set()
+        if max_distance <= default_distance(len(word)):
+            for deleted in deletes(word, max_distance):
+                words = self.word_deletes.get(deleted, set())
+                if isinstance(words, str):
+                    candidates.add(words)
+                else:
+                    candidates |= words
+        else:
+            grams = trigrams(word)
+            postings = sorted((self.word_grams.get(gram, set()) for gram in grams), key=len)
+            if len(grams) <= 4 * max_distance:
+                candidates = set(self.words)
+            for posting in postings[:4 * max_distance + 1]:
+                candidates |= posting
+            candidates = [c for c in candidates if abs(len(c) - len(word)) <= max_distance
+                          and len(grams & trigrams(c)) >= len(grams) - 4 * max_distance]
+        close = {}
+        for candidate in candidates:
+            distance = edit_distance(word, candidate, max_distance)
+            if distance <= max_distance:
+                close[candidate] = distance
+        return close
+
+    def fuzzy_ids(self, key, limit=10, max_distance=None):
+        ''' give the ids of names having a close word for every word of a
+        normalized key, smallest total distance first
+
+        Parameters
+        ----------
+        key: string
+            normalized query
+        limit: int
+            the most ids to give
+        max_distance: int
+            edits allowed per word, see close_words
+
+        Returns
+        -------
+        list
+            ids of the names
+        '''
+        closes = [self.close_words(word, max_distance) for word in key.split()]
+        if len(closes) == 0 or min(len(close) for close in closes) == 0:
+            return []
+        # intersect the names of the close words of every query word, the
+        # query words whose close words are in the fewest names first
+        closes.sort(key=lambda close: sum(len(self.words[word]) for word in close))
+        ids = None
+        for close in closes:
+            names = set().union(*[self.words[word] for word in close])
+            ids = names if ids is None else ids & names
+            if len(ids) == 0:
+                return []
+        found = []
+        for i in ids:
+            words = self.keys[i].split()
+            total = sum(min(close[word] for word in words if word in close) for close in closes)
+            found.append((total, i))
+        return [i for total, i in sorted(found)[:limit]]
+
+    def fuzzy(self, query, limit=10, max_distance=None):
+        ''' give the values of names close to query, allowing typos '''
+        return [self.values[i] for i in self.fuzzy_ids(normalize(query), limit, max_distance)]
+
+    def search(self, query, limit=10):
+        ''' give the best matches of query: exact names first, then names
+        starting with query and names containing query. Only when none of
+        them matches, the names close to query, allowing typos.
+
+        Parameters
+        ----------
+        query: string
+            the text to look up
+        limit: int
+            the most matches to give
+
+        Returns
+        -------
+        list
+            values of the matching names
+        '''
+        key = normalize(query)
+        if len(key) == 0:
+            return []
+        prefix_ids = self.prefix_ids(key, limit)
+        ids = [i for i in prefix_ids if self.keys[i] == key]
+        for i in prefix_ids:
+            if i not in ids:
+                ids.append(i)
+        if len(ids) < limit:
+            for i in self.substring_ids(key, limit):
+                if i not in ids:
+                    ids.append(i)
+        if len(ids) == 0:
+            ids = self.fuzzy_ids(key, limit)
+        return [self.values[i] for i in ids[:limit]]
@@ -0,0 +1,483 @@
+''' Columnar snapshots of the Businesses and Cities tables.
+
+Tables are exported and imported in chunks, so that whole-country tables
+never sit in memory as python rows. The format is chosen by what is
+installed:
+
+    parquet  {table}.parquet, needs pyarrow
+    arrow    {table}.arrow (Arrow IPC file), needs pyarrow
+    npy      {table}.{column}.npy for numeric columns, needs numpy,
+             and {table}.text.csv.gz for the other columns
+    csv      {table}.csv.gz
+
+Each table also gets a {table}.json manifest with its columns, rows and
+the time it was exported.
+read_snapshot() memory-maps arrow, parquet and npy files.
+
+Usage:
+
+    $ python snapshot.py export snapshots/
+    $ python snapshot.py import snapshots/
+'''
+
+import argparse
+import csv
+import gzip
+import json
+import math
+import os
+import sqlite3
+import time
+
+import final_project as fp
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TABLES = ["Cities", "Businesses"]
+FORMATS = ["parquet", "arrow", "npy", "csv"]
+CHUNK_SIZE = 50000
+NULL = "\\N"
+
+
+def default_format():
+    ''' give the most compact format that is installed
+
+    Returns
+    -------
+    string
+        one of FORMATS
+    '''
+    if pa is not None:
+        return "parquet"
+    if np is not None:
+        return "npy"
+    return "csv"
+
+
+def plan_columns(cur, table):
+    ''' decide how each column of a table is stored. A column is "int" or
+    "float" if every value is a number of its declared type (float columns
+    may have NULLs), else "text", which keeps any value.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        cursor of the database
+    table: string
+        table name
+
+    Returns
+    -------
+    list
+        list of {"name", "kind"} dicts, in table column order
+    '''
+    columns = []
+    for row in cur.execute('PRAGMA table_info("%s")' % table).fetchall():
+        name, declared = row[1], row[2].upper()
+        if declared == "INTEGER":
+            kind, allowed = "int", "('integer')"
+        elif declared == "REAL":
+            kind, allowed = "float", "('integer', 'real', 'null')"
+        else:
+            kind, allowed = "text", None
+        if allowed is not None:
+            command = 'SELECT COUNT(*) FROM "%s" WHERE typeof("%s") NOT IN %s' % (
+                table, name, allowed)
+            if cur.execute(command).fetchone()[0] > 0:
+                kind = "text"
+        columns.append({"name": name, "kind": kind})
+    return columns
+
+
+def to_text(value):
+    ''' turn a value of a "text" column into a csv field '''
+    if value is None:
+        return NULL
+    return str(value)
+
+
+def from_text(field, kind="text"):
+    ''' turn a csv field back into a value of a column of a kind '''
+    if field == NULL:
+        return None
+    if kind == "int":
+        return int(field)
+    if kind == "float":
+        return float(field)
+    return field
+
+
+def arrow_schema(columns):
+    ''' make the pyarrow schema of planned columns '''
+    types = {"int": pa.int64(), "float": pa.float64(), "text": pa.string()}
+    return pa.schema([(c["name"], types[c["kind"]]) for c in columns])
+
+
+def arrow_batch(columns, schema, rows):
+    ''' make a pyarrow record batch of rows '''
+    arrays = []
+    for i in range(len(columns)):
+        if columns[i]["kind"] == "text":
+            values = [None if r[i] is None else str(r[i]) for r in rows]
+        else:
+            values = [r[i] for r in rows]
+        arrays.append(pa.array(values, type=schema.field(i).type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_table(cur, table, out_dir, fmt, chunk_size=CHUNK_SIZE, exported_at=None):
+    ''' export a table into out_dir, chunk_size rows at a time
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        cursor of the database
+    table: string
+        table name
+    out_dir: string
+        directory of the snapshot
+    fmt: string
+        one of FORMATS
+    chunk_size: int
+        rows fetched and written at a time
+    exported_at: float
+        seconds since the epoch saved in the manifest, None for now
+
+    Returns
+    -------
+    dict
+        the manifest of the table
+    '''
+    if exported_at is None:
+        exported_at = time.time()
+    columns = plan_columns(cur, table)
+    n_rows = cur.execute('SELECT COUNT(*) FROM "%s"' % table).fetchone()[0]
+    names = [c["name"] for c in columns]
+    cur.execute('SELECT %s FROM "%s" ORDER BY rowid' % (
+        ", ".join('"%s"' % n for n in names), table))
+    files = []
+
+    if fmt in ("parquet", "arrow"):
+        schema = arrow_schema(columns)
+        path = os.path.join(out_dir, "%s.%s" % (table, fmt))
+        if fmt == "parquet":
+            writer = pq.ParquetWriter(path, schema)
+        else:
+            writer = pa.ipc.new_file(path, schema)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            batch = arrow_batch(columns, schema, rows)
+            if fmt == "parquet":
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+        writer.close()
+        files.append(os.path.basename(path))
+
+    elif fmt == "npy":
+        numeric = [i for i in range(len(columns)) if columns[i]["kind"] != "text"]
+        text = [i for i in range(len(columns)) if columns[i]["kind"] == "text"]
+        arrays = {}
+        for i in numeric:
+            path = os.path.join(out_dir, "%s.%s.npy" % (table, names[i]))
+            dtype = np.int64 if columns[i]["kind"] == "int" else np.float64
+            arrays[i] = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(n_rows,))
+            files.append(os.path.basename(path))
+        text_path = os.path.join(out_dir, "%s.text.csv.gz" % table)
+        text_file = gzip.open(text_path, "wt", newline="", encoding="utf-8")
+        writer = csv.writer(text_file)
+        writer.writerow([names[i] for i in text])
+        files.append(os.path.basename(text_path))
+        start = 0
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            for i in numeric:
+                arrays[i][start:start + len(rows)] = [
+                    math.nan if r[i] is None else r[i] for r in rows]
+            writer.writerows([[to_text(r[i]) for i in text] for r in rows])
+            start += len(rows)
+        text_file.close()
+        for i in numeric:
+            arrays[i].flush()
+            del arrays[i]
+
+    else:
+        path = os.path.join(out_dir, "%s.csv.gz" % table)
+        f = gzip.open(path, "wt", newline="", encoding="utf-8")
+        writer = csv.writer(f)
+        writer.writerow(names)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            writer.writerows([[to_text(v) for v in r] for r in rows])
+        f.close()
+        files.append(os.path.basename(path))
+
+    manifest = {"table": table, "format": fmt, "rows": n_rows,
+                "columns": columns, "files": files, "exported_at": exported_at}
+    f = open(os.path.join(out_dir, "%s.json" % table), 'w')
+    f.write(json.dumps(manifest, indent=2))
+    f.close()
+    return manifest
+
+
+def export_snapshot(out_dir, tables=TABLES, fmt=None, chunk_size=CHUNK_SIZE):
+    ''' export tables of the database DB_NAME into out_dir
+
+    Parameters
+    ----------
+    out_dir: string
+        directory of the snapshot, made if it doesn't exist
+    tables: list
+        table names
+    fmt: string
+        one of FORMATS, or None for default_format()
+    chunk_size: int
+        rows fetched and written at a time
+
+    Returns
+    -------
+    list
+        manifests of the tables
+    '''
+    fmt = fmt or default_format()
+    if fmt in ("parquet", "arrow") and pa is None:
+        raise ValueError("%s format needs pyarrow" % fmt)
+    if fmt == "npy" and np is None:
+        raise ValueError("npy format needs numpy")
+    os.makedirs(out_dir, exist_ok=True)
+    conn = sqlite3.connect(fp.DB_NAME)
+    cur = conn.cursor()
+    manifests = []
+    exported_at = time.time()
+    for table in tables:
+        manifests.append(export_table(cur, table, out_dir, fmt, chunk_size, exported_at))
+    conn.close()
+    return manifests
+
+
+def load_manifest(in_dir, table):
+    ''' load the manifest of a table in a snapshot. Manifests saved
+    without "exported_at" get the time the manifest file was written.
+    '''
+    path = os.path.join(in_dir, "%s.json" % table)
+    f = open(path, 'r')
+    manifest = json.loads(f.read())
+    f.close()
+    manifest.setdefault("exported_at", os.path.getmtime(path))
+    return manifest
+
+
+def read_snapshot(in_dir, table):
+    ''' read the columns of a table in a snapshot, memory-mapping
+    arrow, parquet and npy files instead of loading them
+
+    Parameters
+    ----------
+    in_dir: string
+        directory of the snapshot
+    table: string
+        table name
+
+    Returns
+    -------
+    dict
+        key is a column name, value is a pyarrow array, numpy array
+        (numeric columns of npy snapshots) or list
+    '''
+    manifest = load_manifest(in_dir, table)
+    fmt = manifest["format"]
+    names = [c["name"] for c in manifest["columns"]]
+    if fmt in ("parquet", "arrow"):
+        path = os.path.join(in_dir, manifest["files"][0])
+        if fmt == "parquet":
+            arrow_table = pq.read_table(path, memory_map=True)
+        else:
+            arrow_table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        return {name: arrow_table.column(name) for name in names}
+
+    result = {}
+    if fmt == "npy":
+        for c in manifest["columns"]:
+            if c["kind"] != "text":
+                path = os.path.join(in_dir, "%s.%s.npy" % (table, c["name"]))
+                result[c["name"]] = np.load(path, mmap_mode="r")
+        path = os.path.join(in_dir, "%s.text.csv.gz" % table)
+    else:
+        path = os.path.join(in_dir, "%s.csv.gz" % table)
+    f = gzip.open(path, "rt", newline="", encoding="utf-8")
+    reader = csv.reader(f)
+    header = next(reader)
+    kinds = {c["name"]: c["kind"] for c in manifest["columns"]}
+    text_columns = [[] for name in header]
+    for row in reader:
+        for i in range(len(row)):
+            text_columns[i].append(from_text(row[i], kinds[header[i]]))
+    f.close()
+    for i in range(len(header)):
+        result[header[i]] = text_columns[i]
+    return {name: result[name] for name in names}
+
+
+def iter_snapshot_rows(in_dir, table, chunk_size=CHUNK_SIZE):
+    ''' read the rows of a table in a snapshot, chunk_size rows at a time
+
+    Parameters
+    ----------
+    in_dir: string
+        directory of the snapshot
+    table: string
+        table name
+    chunk_size: int
+        rows per chunk
+
+    Returns
+    -------
+    generator
+        lists of row tuples, in table column order
+    '''
+    manifest = load_manifest(in_dir, table)
+    fmt = manifest["format"]
+    columns = manifest["columns"]
+    if fmt in ("parquet", "arrow"):
+        path = os.path.join(in_dir, manifest["files"][0])
+        if fmt == "parquet":
+            batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_size)
+        else:
+            reader = pa.ipc.open_file(pa.memory_map(path))
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        for batch in batches:
+            values = [batch.column(i).to_pylist() for i in range(len(columns))]
+            yield list(zip(*values))
+        return
+
+    if fmt == "npy":
+        arrays = {}
+        for c in columns:
+            if c["kind"] != "text":
+                path = os.path.join(in_dir, "%s.%s.npy" % (table, c["name"]))
+                arrays[c["name"]] = np.load(path, mmap_mode="r")
+        path = os.path.join(in_dir, "%s.text.csv.gz" % table)
+    else:
+        path = os.path.join(in_dir, "%s.csv.gz" % table)
+    f = gzip.open(path, "rt", newline="", encoding="utf-8")
+    reader = csv.reader(f)
+    header = next(reader)
+    start = 0
+    while True:
+        text_rows = []
+        for row in reader:
+            text_rows.append(row)
+            if len(text_rows) == chunk_size:
+                break
+        if len(text_rows) == 0:
+            break
+        values = []
+        for c in columns:
+            if c["name"] in header:
+                i = header.index(c["name"])
+                values.append([from_text(r[i], c["kind"]) for r in text_rows])
+            elif c["kind"] == "int":
+                values.append([int(v) for v in arrays[c["name"]][start:start + len(text_rows)]])
+            else:
+                values.append([None if math.isnan(v) else float(v)
+                               for v in arrays[c["name"]][start:start + len(text_rows)]])
+        start += len(text_rows)
+        yield list(zip(*values))
+    f.close()
+
+
+def import_snapshot(in_dir, tables=TABLES, chunk_size=CHUNK_SIZE):
+    ''' replace the rows of tables of the database DB_NAME with a snapshot,
+    chunk_size rows at a time, in one transaction. When Businesses is
+    replaced, every city of CityRefresh or of the imported rows (with the
+    state of its CityId) is marked as fetched when the snapshot was
+    exported, and its fingerprint is
+    cleared. The imported rows are then kept until they are as stale as
+    the export, and the next fetch of a city writes its changes to them.
+
+    Parameters
+    ----------
+    in_dir: string
+        directory of the snapshot
+    tables: list
+        table names
+    chunk_size: int
+        rows read and inserted at a time
+
+    Returns
+    -------
+    dict
+        key is a table name, value is the number of imported rows
+    '''
+    conn = sqlite3.connect(fp.DB_NAME)
+    cur = conn.cursor()
+    fp.create_city_table(cur)
+    fp.create_business_table(cur)
+    fp.create_refresh_table(cur)
+    counts = {}
+    exported_at = None
+    for table in tables:
+        manifest = load_manifest(in_dir, table)
+        names = [c["name"] for c in manifest["columns"]]
+        insert = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
+            table, ", ".join('"%s"' % n for n in names), ", ".join(["?"] * len(names)))
+        cur.execute('DELETE FROM "%s"' % table)
+        counts[table] = 0
+        for rows in iter_snapshot_rows(in_dir, table, chunk_size):
+            cur.executemany(insert, rows)
+            counts[table] += len(rows)
+        if table == "Businesses":
+            exported_at = manifest["exported_at"]
+    fp.bump_businesses_version(cur)
+    if exported_at is not None:
+        cur.execute("UPDATE CityRefresh SET LastFetch = ?, Fingerprint = NULL", (exported_at,))
+        cur.execute('''INSERT OR IGNORE INTO CityRefresh (City, State, LastFetch)
+                       SELECT DISTINCT b.City, COALESCE(c.State, ''), ? FROM Businesses as b
+                       LEFT JOIN Cities as c ON c.Id = b.CityId
+                       WHERE NOT EXISTS (SELECT 1 FROM CityRefresh as r WHERE r.City = b.City)''',
+                    (exported_at,))
+    conn.commit()
+    conn.close()
+    fp.invalidate_city_dataset()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or import table snapshots.")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("directory", help="directory of the snapshot")
+    parser.add_argument("--format", choices=FORMATS, default=None,
+                        help="export format, default %s" % default_format())
+    parser.add_argument("--tables", nargs="+", default=TABLES, choices=TABLES)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--db", default=fp.DB_NAME, help="path of the database")
+    args = parser.parse_args(argv)
+    fp.DB_NAME = args.db
+
+    if args.action == "export":
+        for manifest in export_snapshot(args.directory, args.tables, args.format, args.chunk_size):
+            print("%s: %s rows exported as %s" % (
+                manifest["table"], manifest["rows"], manifest["format"]))
+    else:
+        counts = import_snapshot(args.directory, args.tables, args.chunk_size)
+        for table in counts:
+            print("%s: %s rows imported" % (table, counts[table]))
+
+
+if __name__ == "__main__":
+    main()
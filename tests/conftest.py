@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import final_project as fp
+import metrics
+
+CITIES = {"michigan": ["Ann Arbor", "Detroit"], "maine": ["Portland"], "oregon": ["Portland"]}
+
+
+def make_business(i, city="Ann Arbor", **fields):
+    ''' make one business of a yelp api result '''
+    bu = {"id": "yelp-%s" % i, "name": "Cafe %s" % i,
+          "location": {"city": city, "address1": "%s Main St" % i, "zip_code": "48104"},
+          "coordinates": {"latitude": 42.0 + i / 100, "longitude": -83.0},
+          "price": "$" * (1 + i % 3), "image_url": "", "rating": 3.0 + (i % 5) / 2,
+          "review_count": 10 * i}
+    bu.update(fields)
+    return bu
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    ''' final_project with an empty database, cache and quota in tmp_path '''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fp, "DB_NAME", str(tmp_path / "test_db.sqlite"))
+    monkeypatch.setattr(fp, "CACHE_DICT", {})
+    fp.invalidate_city_dataset()
+    metrics.reset()
+    fp.save_city_table(CITIES)
+    return fp
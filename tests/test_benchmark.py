@@ -0,0 +1,12 @@
+import pytest
+
+import benchmark
+
+
+@pytest.mark.parametrize("seed", [1, 2, 6, 7, 507])
+def test_smallest_benchmark_runs_every_stage(seed):
+    run = benchmark.run_benchmark(10, 5, seed=seed)
+    assert run["cities"] == 5
+    assert sorted(run["stages"]) == sorted(benchmark.STAGES)
+    assert run["stages"]["ingest"]["items"] == 10
+    assert run["stages"]["figure"]["items"] == 3 * 5
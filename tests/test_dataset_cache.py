@@ -0,0 +1,63 @@
+import sqlite3
+
+import metrics
+from conftest import make_business
+
+
+def sync(fp, city, n):
+    return fp.sync_city_businesses(city, {"businesses": [make_business(i, city) for i in range(n)]})
+
+
+def test_switching_cities_costs_no_query(db):
+    sync(db, "Ann Arbor", 4)
+    sync(db, "Detroit", 2)
+    assert len(db.get_city_dataset("Ann Arbor")) == 4
+    db.record_city_use("Detroit")
+    assert len(db.get_city_dataset("Detroit")) == 2
+    db.record_city_use("Ann Arbor")
+    queries = metrics.counter_total("db_rows_scanned_total")
+    db.get_aver_db("rating", {"City": "Ann Arbor"})
+    db.get_best_busi({"City": "Ann Arbor"})
+    db.get_price_rating_matrix("Ann Arbor")
+    db.get_city_dataset("Detroit")
+    assert metrics.counter_total("db_rows_scanned_total") == queries
+    assert metrics.counter_total("dataset_cache_misses_total") == 2
+    assert metrics.counter_total("dataset_cache_hits_total") == 4
+
+
+def test_sync_invalidates_its_city(db):
+    sync(db, "Ann Arbor", 4)
+    sync(db, "Detroit", 2)
+    assert len(db.get_city_dataset("Ann Arbor")) == 4
+    assert len(db.get_city_dataset("Detroit")) == 2
+    sync(db, "Ann Arbor", 3)
+    assert len(db.get_city_dataset("Ann Arbor")) == 3
+    assert metrics.counter_total("dataset_cache_misses_total") == 3
+
+
+def test_least_recently_used_city_is_dropped(db, monkeypatch):
+    monkeypatch.setattr(db, "DATASET_CACHE_SIZE", 2)
+    sync(db, "Ann Arbor", 4)
+    for city in ["Ann Arbor", "Detroit", "Ann Arbor", "Lansing"]:
+        db.get_city_dataset(city)
+    assert [key[1] for key in db.DATASET_CACHE] == ["Ann Arbor", "Lansing"]
+
+
+def test_write_of_another_program_is_seen(db):
+    sync(db, "Ann Arbor", 4)
+    sync(db, "Detroit", 2)
+    assert len(db.get_city_dataset("Ann Arbor")) == 4
+    assert len(db.get_city_dataset("Detroit")) == 2
+    sync(db, "Ann Arbor", 3)
+    db.record_city_use("Detroit")
+    assert len(db.get_city_dataset("Detroit")) == 2
+    assert metrics.counter_total("dataset_cache_misses_total") == 2
+    # e.g. refresh.py, running next to this program
+    conn = sqlite3.connect(db.DB_NAME)
+    conn.execute("DELETE FROM Businesses WHERE City = 'Detroit' AND YelpId = 'yelp-0'")
+    conn.execute("UPDATE BusinessesVersion SET Version = Version + 1")
+    conn.commit()
+    conn.close()
+    assert len(db.get_city_dataset("Detroit")) == 1
+    assert len(db.get_city_dataset("Ann Arbor")) == 3
+    assert metrics.counter_total("dataset_cache_misses_total") == 4
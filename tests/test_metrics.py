@@ -0,0 +1,61 @@
+import threading
+
+import metrics
+from conftest import make_business
+from test_quota import FakeResponse, fake_get
+
+
+def test_dumps_while_other_threads_record():
+    metrics.reset()
+    done = threading.Event()
+
+    def record():
+        i = 0
+        while not done.is_set():
+            metrics.inc("requests_total", status=i % 50)
+            metrics.observe("request_seconds", 0.01, route=i % 50)
+            i += 1
+    writer = threading.Thread(target=record)
+    writer.start()
+    try:
+        for i in range(200):
+            metrics.to_prometheus()
+            metrics.to_json()
+            metrics.summary()
+    finally:
+        done.set()
+        writer.join()
+    assert metrics.counter_total("requests_total") > 0
+    metrics.reset()
+
+
+def test_hot_paths_record_metrics_and_prometheus_text(db, monkeypatch):
+    fake_get(monkeypatch, db, [FakeResponse(200, {"businesses": [make_business(0)]})])
+    db.sync_city_businesses("Ann Arbor", {"businesses": [make_business(i) for i in range(3)]})
+    metrics.reset()
+    params = {"location": "Ann Arbor", "term": "coffee", "limit": 50}
+    db.make_api_request_with_cache("url", params)
+    db.make_api_request_with_cache("url", params)
+    assert len(db.get_busi_db_info(["Name"], {"City": "Ann Arbor"})) == 3
+    db.review_rating_scatter("Ann Arbor")
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"][("cache_misses_total", (("kind", "api"),))] == 1
+    assert snapshot["counters"][("cache_hits_total", (("kind", "api"),))] == 1
+    assert snapshot["counters"][("http_requests_total", (("kind", "api"), ("status", "200")))] == 1
+    assert metrics.counter_total("db_rows_scanned_total") == 6
+    assert snapshot["histograms"][("figure_build_seconds",
+                                   (("figure", "review_rating_scatter"),))]["count"] == 1
+
+    text = metrics.to_prometheus()
+    lines = text.splitlines()
+    assert "# TYPE final_project_cache_hits_total counter" in lines
+    assert 'final_project_http_requests_total{kind="api",status="200"} 1' in lines
+    assert lines.count("# TYPE final_project_sql_seconds histogram") == 1
+    buckets = [line for line in lines
+               if line.startswith('final_project_sql_seconds_bucket{op="get_busi_db_info",')]
+    assert len(buckets) == len(metrics.BUCKETS)
+    counts = [int(line.split()[-1]) for line in buckets]
+    assert counts == sorted(counts)
+    assert buckets[-1] == 'final_project_sql_seconds_bucket{op="get_busi_db_info",le="+Inf"} 2'
+    assert 'final_project_sql_seconds_count{op="get_busi_db_info"} 2' in lines
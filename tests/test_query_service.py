@@ -0,0 +1,51 @@
+import json
+import sqlite3
+
+import pytest
+
+import query_service as qs
+from conftest import make_business
+
+
+def test_non_finite_ratings_are_rejected(db):
+    db.sync_city_businesses("Ann Arbor", {"businesses": [make_business(0)]})
+    service = qs.QueryService(db.DB_NAME, pool_size=1)
+    for route, params in [("/price", {"city": "Ann Arbor", "rating": "nan"}),
+                          ("/price", {"city": "Ann Arbor", "rating": "inf"}),
+                          ("/price_matrix", {"city": "Ann Arbor", "min_rating": "-inf"}),
+                          ("/price_matrix", {"state": "michigan", "max_rating": "NaN"})]:
+        status, body = service.run_route(qs.ROUTES[route], params)
+        assert status == 400
+        assert "finite" in json.loads(body)["error"]
+    status, body = service.run_route(qs.ROUTES["/price"], {"city": "Ann Arbor", "rating": "3"})
+    assert status == 200
+    assert json.loads(body) == {"city": "Ann Arbor", "rating": 3.0, "prices": {"level 1": 1}}
+    service.pool.close()
+
+
+@pytest.mark.parametrize("businesses", [[make_business(0)],
+                                        [make_business(0), make_business(5)]])
+def test_kde_of_too_few_ratings_is_not_found(db, businesses):
+    db.sync_city_businesses("Ann Arbor", {"businesses": businesses})
+    conn = sqlite3.connect(db.DB_NAME)
+    with pytest.raises(LookupError, match="fewer than 2 different ratings"):
+        qs.ROUTES["/figure/kde"]({"city": "Ann Arbor"}, conn)
+    conn.close()
+
+
+def test_map_is_served_without_mapbox_token(db):
+    db.sync_city_businesses("Ann Arbor", {"businesses": [make_business(i) for i in range(2)]})
+    conn = sqlite3.connect(db.DB_NAME)
+    figure = json.loads(qs.ROUTES["/figure/map"]({"city": "Ann Arbor"}, conn))
+    conn.close()
+    assert "accesstoken" not in figure["layout"]["mapbox"]
+    assert db.mapbox_token not in json.dumps(figure)
+
+
+def test_price_of_unknown_city_is_not_found(db):
+    db.sync_city_businesses("Ann Arbor", {"businesses": [make_business(0)]})
+    service = qs.QueryService(db.DB_NAME, pool_size=1)
+    status, body = service.run_route(qs.ROUTES["/price"], {"city": "Atlantis"})
+    assert status == 404
+    assert json.loads(body) == {"error": "no cafe in Atlantis"}
+    service.pool.close()
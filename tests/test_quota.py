@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+
+class FakeResponse():
+    ''' a yelp api response with rate-limit headers '''
+    def __init__(self, status_code, body, remaining=4200):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {"RateLimit-DailyLimit": "5000", "RateLimit-Remaining": str(remaining)}
+
+    def json(self):
+        return self.body
+
+
+def fake_get(monkeypatch, fp, responses):
+    ''' answer requests.get with the responses in order, counting calls '''
+    sent = []
+
+    def get(baseurl, headers=None, params=None):
+        sent.append(params)
+        return responses[min(len(sent), len(responses)) - 1]
+    monkeypatch.setattr(fp.requests, "get", get)
+    monkeypatch.setattr(fp, "THROTTLE_RETRY_SECONDS", [0, 0])
+    return sent
+
+
+def throttled(remaining=4200):
+    return FakeResponse(429, {"error": {"code": "TOO_MANY_REQUESTS_PER_SECOND"}}, remaining)
+
+
+def test_per_second_429_is_retried_and_keeps_quota(db, monkeypatch):
+    sent = fake_get(monkeypatch, db, [throttled(), FakeResponse(200, {"businesses": []}, 4199)])
+    assert db.make_api_request("url", {}) == {"businesses": []}
+    assert len(sent) == 2
+    assert db.remaining_quota() == 4199
+
+
+def test_per_second_429_after_retries_is_not_quota_exceeded(db, monkeypatch):
+    sent = fake_get(monkeypatch, db, [throttled()])
+    with pytest.raises(db.YelpApiError) as e:
+        db.make_api_request("url", {})
+    assert not isinstance(e.value, db.QuotaExceededError)
+    assert len(sent) == 3
+    assert db.remaining_quota() == 4200
+
+
+def test_daily_limit_429_uses_up_quota(db, monkeypatch):
+    sent = fake_get(monkeypatch, db, [
+        FakeResponse(429, {"error": {"code": "ACCESS_LIMIT_REACHED"}}, 4200)])
+    with pytest.raises(db.QuotaExceededError):
+        db.make_api_request("url", {})
+    assert db.remaining_quota() == 0
+    with pytest.raises(db.QuotaExceededError):
+        db.make_api_request("url", {})
+    assert len(sent) == 1
+
+
+def test_429_with_no_call_remaining_uses_up_quota(db, monkeypatch):
+    fake_get(monkeypatch, db, [throttled(remaining=0)])
+    with pytest.raises(db.QuotaExceededError):
+        db.make_api_request("url", {})
+    assert db.remaining_quota() == 0
+
+
+def test_threads_can_not_spend_the_last_call_twice(db, monkeypatch):
+    sent = fake_get(monkeypatch, db, [FakeResponse(200, {"businesses": []}, 0)])
+    get = db.requests.get
+
+    def slow_get(*args, **kwargs):
+        time.sleep(0.05)
+        return get(*args, **kwargs)
+    monkeypatch.setattr(db.requests, "get", slow_get)
+    quota = db.load_quota()
+    quota["remaining"] = 1
+    db.save_quota(quota)
+    errors = []
+
+    def call():
+        try:
+            db.make_api_request("url", {})
+        except db.QuotaExceededError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=call) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(sent) == 1
+    assert len(errors) == 2
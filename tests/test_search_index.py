@@ -0,0 +1,42 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import search_index as si
+from conftest import make_business
+
+
+def test_close_words_finds_every_word_within_distance():
+    rng = random.Random(507)
+    words = ["".join(rng.choice("abcde") for i in range(rng.randint(1, 12))) for j in range(500)]
+    index = si.SearchIndex(words)
+    for j in range(100):
+        query = "".join(rng.choice("abcde") for i in range(rng.randint(1, 12)))
+        for max_distance in (None, 1, 3):
+            distance = max_distance or si.default_distance(len(query))
+            expected = {}
+            for word in index.words:
+                d = si.edit_distance(query, word, distance)
+                if d <= distance:
+                    expected[word] = d
+            assert index.close_words(query, max_distance) == expected
+
+
+def test_fuzzy_matches_every_query_word_allowing_typos():
+    index = si.SearchIndex(["Blue Bottle Coffee", "Coffee Bar", "Bottle Shop", "Blue Tea House"])
+    assert index.fuzzy("bleu botle") == ["Blue Bottle Coffee"]
+    assert index.fuzzy("cofee") == ["Blue Bottle Coffee", "Coffee Bar"]
+    assert index.fuzzy("zzzz") == []
+    assert index.search("blue") == ["Blue Bottle Coffee", "Blue Tea House"]
+
+
+def test_cafe_index_is_rebuilt_only_after_businesses_change(db):
+    db.sync_city_businesses("Ann Arbor", {"businesses": [make_business(i) for i in range(2)]})
+    index = db.get_cafe_index()
+    db.record_city_use("Detroit")
+    assert db.get_cafe_index() is index
+    db.sync_city_businesses("Ann Arbor", {"businesses": [make_business(i) for i in range(3)]})
+    assert db.get_cafe_index() is not index
+    assert [cafe[0] for cafe in db.search_cafes("cafe 2")] == ["Cafe 2"]
@@ -0,0 +1,49 @@
+import time
+
+import snapshot
+from conftest import make_business
+from test_sync import cache_result
+
+
+def test_csv_snapshot_keeps_numeric_columns(db, tmp_path):
+    db.sync_city_businesses("Ann Arbor", {"businesses": [make_business(i) for i in range(3)]})
+    snapshot.export_snapshot(str(tmp_path / "snap"), ["Businesses"], "csv")
+    columns = snapshot.read_snapshot(str(tmp_path / "snap"), "Businesses")
+    assert columns["Id"] == [1, 2, 3]
+    assert columns["Rating"] == [3.0, 3.5, 4.0]
+    assert columns["Name"] == ["Cafe 0", "Cafe 1", "Cafe 2"]
+    rows = [r for rows in snapshot.iter_snapshot_rows(str(tmp_path / "snap"), "Businesses", 2)
+            for r in rows]
+    assert [(r[0], r[9]) for r in rows] == [(1, 3.0), (2, 3.5), (3, 4.0)]
+
+
+def test_import_keeps_rows_as_old_as_the_export(db, tmp_path, monkeypatch):
+    businesses = [make_business(i) for i in range(3)]
+    cache_result(db, "Ann Arbor", businesses, time.time())
+    db.sync_city_businesses("Ann Arbor", {"businesses": businesses[:1]})
+    manifests = snapshot.export_snapshot(str(tmp_path / "snap"), fmt="csv")
+    db.sync_city_businesses("Ann Arbor", {"businesses": businesses})
+    assert len(db.get_city_dataset("Ann Arbor")) == 3
+    snapshot.import_snapshot(str(tmp_path / "snap"))
+    assert len(db.get_city_dataset("Ann Arbor")) == 1
+    assert db.get_last_fetch("Ann Arbor") == manifests[-1]["exported_at"]
+
+    def no_request(baseurl, params):
+        raise AssertionError("fetched from yelp")
+    monkeypatch.setattr(db, "make_api_request", no_request)
+    db.load_city_businesses("Ann Arbor")
+    assert len(db.get_city_dataset("Ann Arbor")) == 1
+
+
+def test_import_of_stale_export_is_refreshed(db, tmp_path, monkeypatch):
+    businesses = [make_business(i) for i in range(3)]
+    db.sync_city_businesses("Ann Arbor", {"businesses": businesses[:1]})
+    snapshot.export_snapshot(str(tmp_path / "snap"), fmt="csv")
+    snapshot.import_snapshot(str(tmp_path / "snap"))
+
+    def request(baseurl, params):
+        return {"businesses": businesses, "total": len(businesses)}
+    monkeypatch.setattr(db, "make_api_request", request)
+    refreshed = db.refresh_stale_cities(freshness=-1)
+    assert refreshed == [("Ann Arbor", {"inserted": 2, "updated": 1, "deleted": 0})]
+    assert len(db.get_city_dataset("Ann Arbor")) == 3
@@ -0,0 +1,175 @@
+import sqlite3
+import time
+
+import pytest
+
+from conftest import make_business
+
+
+def cache_result(fp, city, businesses, fetched_at=None, terms=None):
+    ''' put the api result of search terms of a city in the cache,
+    every term of fp.SEARCH_TERMS if terms is None '''
+    yelp_url = "https://api.yelp.com/v3/businesses/search"
+    for term in terms or fp.SEARCH_TERMS:
+        result = {"businesses": businesses, "total": len(businesses)}
+        if fetched_at is not None:
+            result["fetched_at"] = fetched_at
+        params = {"location": city, "term": term, "limit": 50}
+        fp.CACHE_DICT[fp.construct_unique_key(yelp_url, params)] = result
+
+
+def test_first_fetch_keeps_time_of_cached_result(db):
+    fetched_at = time.time() - 30 * 24 * 60 * 60
+    cache_result(db, "Ann Arbor", [make_business(0)], fetched_at)
+    db.fetch_city_businesses("Ann Arbor")
+    assert db.get_last_fetch("Ann Arbor") == fetched_at
+
+
+def test_first_fetch_of_result_cached_without_time_is_stale(db):
+    cache_result(db, "Ann Arbor", [make_business(0)])
+    db.fetch_city_businesses("Ann Arbor")
+    assert db.get_last_fetch("Ann Arbor") == 0
+
+
+def rows(fp, city="Ann Arbor"):
+    return sorted(fp.get_busi_db_info(["Name", "Rating", "YelpId"], {"City": city}))
+
+
+def test_sync_inserts_updates_and_deletes_only_changes(db):
+    businesses = [make_business(i) for i in range(4)]
+    assert db.sync_city_businesses("Ann Arbor", {"businesses": businesses}) == \
+        {"inserted": 4, "updated": 0, "deleted": 0}
+    ids = dict((r[2], r[0]) for r in db.get_busi_db_info(["Id", "Name", "YelpId"]))
+    businesses = businesses[1:3] + [make_business(3, rating=1.0), make_business(4)]
+    assert db.sync_city_businesses("Ann Arbor", {"businesses": businesses}) == \
+        {"inserted": 1, "updated": 1, "deleted": 1}
+    assert rows(db) == [("Cafe 1", 3.5, "yelp-1"), ("Cafe 2", 4.0, "yelp-2"),
+                        ("Cafe 3", 1.0, "yelp-3"), ("Cafe 4", 5.0, "yelp-4")]
+    after = dict((r[2], r[0]) for r in db.get_busi_db_info(["Id", "Name", "YelpId"]))
+    assert all(after[key] == ids[key] for key in ["yelp-1", "yelp-2", "yelp-3"])
+
+
+def test_sync_skips_unchanged_result(db):
+    result = {"businesses": [make_business(i) for i in range(3)]}
+    db.sync_city_businesses("Ann Arbor", result)
+    assert db.sync_city_businesses("Ann Arbor", result) == \
+        {"inserted": 0, "updated": 0, "deleted": 0}
+    assert len(rows(db)) == 3
+
+
+def test_sync_only_touches_its_city(db):
+    db.sync_city_businesses("Detroit", {"businesses": [make_business(9, "Detroit")]})
+    db.sync_city_businesses("Ann Arbor", {"businesses": [make_business(0)]})
+    db.sync_city_businesses("Ann Arbor", {"businesses": []})
+    assert rows(db) == []
+    assert rows(db, "Detroit") == [("Cafe 9", 3.0 + 9 % 5 / 2, "yelp-9")]
+
+
+def test_sync_cleans_up_legacy_duplicate_rows(db):
+    businesses = [make_business(i) for i in range(2)]
+    for i in range(2):
+        # saved without a yelp id, matched by name and address
+        db.Business("Cafe 0", "Ann Arbor", "0 Main St", 42.0, -83.0, "48104",
+                    "$", "", 3.0, 0, save=True)
+        # saved once per use of the city
+        db.build_buss_objs_from_dict("Ann Arbor", {"businesses": businesses[1:]}, save=True)
+    assert len(rows(db)) == 4
+    assert db.sync_city_businesses("Ann Arbor", {"businesses": businesses}) == \
+        {"inserted": 0, "updated": 1, "deleted": 2}
+    assert rows(db) == [("Cafe 0", 3.0, "yelp-0"), ("Cafe 1", 3.5, "yelp-1")]
+
+
+def test_build_buss_objs_does_not_save_by_default(db):
+    db.sync_city_businesses("Ann Arbor", {"businesses": []})
+    objs = db.build_buss_objs_from_dict("Ann Arbor", {"businesses": [make_business(0)]})
+    assert len(objs) == 1
+    assert rows(db) == []
+
+
+def test_state_matrix_counts_city_of_its_state(db):
+    businesses = [make_business(i, "Portland") for i in range(4)]
+    db.sync_city_businesses("Portland", {"businesses": businesses}, state="Oregon")
+    db.sync_city_businesses("Ann Arbor", {"businesses": [make_business(0)]}, state="michigan")
+    assert db.get_price_rating_matrix(state="maine") == {}
+    assert db.get_price_rating_matrix(state="oregon") == \
+        {3.0: {"level 1": 1}, 3.5: {"level 2": 1}, 4.0: {"level 3": 1}, 4.5: {"level 1": 1}}
+    assert db.get_price_rating_matrix(state="oregon", min_rating=4) == \
+        {4.0: {"level 3": 1}, 4.5: {"level 1": 1}}
+    assert db.get_price_rating_matrix(state="michigan") == {3.0: {"level 1": 1}}
+
+
+def without_id(bu):
+    return dict((k, v) for k, v in bu.items() if k != "id")
+
+
+def test_terms_are_merged_into_one_row_per_business(db):
+    now = time.time()
+    cache_result(db, "Ann Arbor", [make_business(0), make_business(1)], now, ["coffee"])
+    cache_result(db, "Ann Arbor", [make_business(1), make_business(2),
+                                   without_id(make_business(3))], now - 60, ["tea"])
+    cache_result(db, "Ann Arbor", [make_business(2), without_id(make_business(3))],
+                 now - 30, ["bakery"])
+    db.fetch_city_businesses("Ann Arbor")
+    assert sorted(db.get_busi_db_info(["Name", "YelpId", "Terms"], {"City": "Ann Arbor"})) == \
+        [("Cafe 0", "yelp-0", "coffee"), ("Cafe 1", "yelp-1", "coffee,tea"),
+         ("Cafe 2", "yelp-2", "tea,bakery"), ("Cafe 3", "", "tea,bakery")]
+    assert db.get_last_fetch("Ann Arbor") == now - 60
+
+
+def test_error_of_any_term_syncs_nothing(db, monkeypatch):
+    db.sync_city_businesses("Detroit", {"businesses": [make_business(9, "Detroit")]})
+    cache_result(db, "Ann Arbor", [make_business(0)], time.time(), ["coffee", "tea"])
+
+    def request(baseurl, params):
+        return {"error": {"code": "INTERNAL_ERROR"}}
+    monkeypatch.setattr(db, "make_api_request", request)
+    with pytest.raises(db.YelpApiError):
+        db.fetch_city_businesses("Ann Arbor")
+    assert rows(db) == []
+    assert db.get_last_fetch("Ann Arbor") is None
+
+
+def test_same_city_name_in_two_states_keeps_separate_rows(db):
+    oregon = [make_business(i, "Portland") for i in range(4)]
+    maine = [make_business(i, "Portland") for i in range(10, 12)]
+    cache_result(db, "Portland, oregon", oregon, time.time())
+    cache_result(db, "Portland, maine", maine, time.time())
+    db.fetch_city_businesses("Portland", state="oregon")
+    db.fetch_city_businesses("Portland", state="maine")
+    assert sum(sum(p.values()) for p in db.get_price_rating_matrix(state="oregon").values()) == 4
+    assert sum(sum(p.values()) for p in db.get_price_rating_matrix(state="maine").values()) == 2
+    # the same result under the other state is not skipped as unchanged
+    assert db.sync_city_businesses("Portland", {"businesses": oregon}, state="maine") == \
+        {"inserted": 4, "updated": 0, "deleted": 2}
+    assert db.sync_city_businesses("Portland", {"businesses": oregon[:1]}, state="oregon") == \
+        {"inserted": 0, "updated": 1, "deleted": 3}
+    assert sum(sum(p.values()) for p in db.get_price_rating_matrix(state="oregon").values()) == 1
+    assert sum(sum(p.values()) for p in db.get_price_rating_matrix(state="maine").values()) == 4
+
+
+def test_refresh_table_keyed_by_name_is_migrated(db):
+    conn = sqlite3.connect(db.DB_NAME)
+    conn.execute('''CREATE TABLE "CityRefresh" ("City" TEXT PRIMARY KEY,
+                    "Uses" INTEGER NOT NULL DEFAULT 0, "LastFetch" REAL, "Fingerprint" TEXT)''')
+    conn.execute("INSERT INTO CityRefresh VALUES ('Ann Arbor', 3, 12.0, 'abc')")
+    conn.commit()
+    conn.close()
+    assert db.get_last_fetch("Ann Arbor") == 12.0
+    db.record_city_use("Ann Arbor", "michigan")
+    assert db.get_last_fetch("Ann Arbor", "michigan") is None
+    assert db.get_last_fetch("Ann Arbor") == 12.0
+
+
+def test_fresh_city_missing_from_cache_is_listed_from_database(db, monkeypatch):
+    businesses = [make_business(i) for i in range(3)]
+    db.sync_city_businesses("Ann Arbor", {"businesses": businesses, "fetched_at": time.time()})
+
+    def no_request(baseurl, params):
+        raise AssertionError("fetched from yelp")
+    monkeypatch.setattr(db, "make_api_request", no_request)
+    result = db.fetch_city_businesses("Ann Arbor")
+    assert result["total"] == 3
+    listed = [bu.info() for bu in db.build_buss_objs_from_dict("Ann Arbor", result)]
+    attr_lists = db.parse_buss_attrs("Ann Arbor", {"businesses": businesses})
+    assert sorted(listed) == sorted(db.Business(*a, save=False).info() for a in attr_lists)
+    assert len(rows(db)) == 3